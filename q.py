@@ -59,9 +59,42 @@ ESCAPE_SEQUENCES = ['\x1b[0m'] + ['\x1b[3%dm' % i for i in range(1, 7)]
 if sys.version_info >= (3,):
     BASESTRING_TYPES = (str, bytes)
     TEXT_TYPES = (str,)
+    INTEGER_TYPES = (int,)
 else:
     BASESTRING_TYPES = (basestring,)  # noqa
     TEXT_TYPES = (unicode,)  # noqa
+    INTEGER_TYPES = (int, long)  # noqa
+
+
+class LazyModule(object):
+    """A class attribute that imports a module the first time it's used,
+    then replaces itself on the class with the module.  This keeps modules
+    that are slow to import (and only needed for some features) from slowing
+    down "import q"."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        module = __import__(self.name)
+        setattr(owner, self.name, module)
+        return module
+
+
+def get_temp_dir():
+    """Gets the directory that tempfile.gettempdir() would, without having
+    to import tempfile in the usual case that the first candidate works."""
+    import os
+    for name in ['TMPDIR', 'TEMP', 'TMP']:
+        path = os.environ.get(name)
+        if path:
+            break
+    else:
+        path = os.name == 'posix' and '/tmp'
+    if path and os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+        return os.path.abspath(path)
+    import tempfile
+    return tempfile.gettempdir()
 
 
 # When we insert Q() into sys.modules, all the globals become None, so we
@@ -69,47 +102,53 @@ else:
 class Q(object):
     __doc__ = __doc__  # from the module's __doc__ above
 
-    import ast
-    import code
-    import dis
-    import functools
-    import inspect
+    import atexit
     import os
-    import pydoc
-    import random
-    import re
     import sys
-    import tempfile
+    import threading
     import time
+    import weakref
+
+    # These are only imported when they are first needed.
+    ast = LazyModule('ast')  # for labelling values with their expressions
+    asyncio = LazyModule('asyncio')  # for marking traced async functions
+    code = LazyModule('code')  # for q.d()
+    dis = LazyModule('dis')  # for finding calls on a line
+    fnmatch = LazyModule('fnmatch')  # for q.trace_module()
+    functools = LazyModule('functools')  # for @q
+    inspect = LazyModule('inspect')  # for source lines in unusual places
+    re = LazyModule('re')  # for parsing source lines
+    signal = LazyModule('signal')  # for q.flight_recorder()
+    socket = LazyModule('socket')  # for q.sink() and q.collect()
 
     # The debugging log will go to this file; temporary files will also have
-    # this path as a prefix, followed by a random number.
-    OUTPUT_PATH = os.path.join(tempfile.gettempdir(), 'q')
+    # this path as a prefix, followed by a hash of their contents.
+    OUTPUT_PATH = os.path.join(get_temp_dir(), 'q')
 
     NORMAL, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN = ESCAPE_SEQUENCES
-    TEXT_REPR = pydoc.TextRepr()
+    REPR = None  # built by get_repr when it's first needed
+    # The limits of pydoc's TextRepr, which q.short used to use.
+    SHORT_REPR_LIMITS = dict(max_items=20, max_dict_items=10, max_level=6,
+                             max_string=100)
     q_max_length = 1000000
+    q_long = True
+
+    # Appended to reprs that were cut short by the per-record budget.
+    TRUNCATED = '...[truncated]'
+    clock = getattr(time, 'perf_counter', time.time)
+    cpu_clock = getattr(time, 'process_time', None) or time.clock
 
     @property
     def short(self):
         cls = self.__class__
-        cls.TEXT_REPR = cls.pydoc.TextRepr()
+        cls.q_long = False
+        cls.REPR = None
 
     @property
     def long(self):
         cls = self.__class__
-        cls.TEXT_REPR = cls.pydoc.TextRepr()
-        cls.TEXT_REPR.maxarray = cls.q_max_length
-        cls.TEXT_REPR.maxdeque = cls.q_max_length
-        cls.TEXT_REPR.maxdict = cls.q_max_length
-        cls.TEXT_REPR.maxfrozenset = cls.q_max_length
-        cls.TEXT_REPR.maxlevel = cls.q_max_length
-        cls.TEXT_REPR.maxlist = cls.q_max_length
-        cls.TEXT_REPR.maxlong = cls.q_max_length
-        cls.TEXT_REPR.maxother = cls.q_max_length
-        cls.TEXT_REPR.maxset = cls.q_max_length
-        cls.TEXT_REPR.maxstring = cls.q_max_length
-        cls.TEXT_REPR.maxtuple = cls.q_max_length
+        cls.q_long = True
+        cls.REPR = None
 
     @long.setter
     def long(self, value):
@@ -150,8 +189,764 @@ class Q(object):
             except IOError:
                 pass
 
+        def flush(self):
+            pass
+
+        def close(self):
+            pass
+
+    class StreamWriter(object):
+        """An object that writes to an open stream, such as sys.stdout."""
+
+        def __init__(self, stream):
+            self.stream = stream
+
+        def write(self, mode, content):
+            self.stream.write(content)
+
+        def flush(self):
+            self.stream.flush()
+
+        def close(self):
+            self.flush()
+
+    class BufferedFileWriter(object):
+        """An object that appends to a single file through a descriptor that
+        stays open, buffering output until there is enough of it, it has
+        waited long enough, or the interpreter exits."""
+        import atexit
+        import os
+        import threading
+        try:
+            import fcntl
+        except ImportError:  # not on Windows
+            fcntl = None
+        try:
+            from select import PIPE_BUF
+        except ImportError:
+            PIPE_BUF = 512  # the minimum that POSIX allows
+
+        # For portably converting strings between python2 and python3
+        BASESTRING_TYPES = BASESTRING_TYPES
+        TEXT_TYPES = TEXT_TYPES
+
+        def __init__(self, path, max_size=65536, max_delay=0.5):
+            self.path = path
+            self.max_size = max_size
+            self.max_delay = max_delay
+            self.fd = None
+            self.inode = None
+            self.buffer = []
+            self.size = 0
+            self.timer = None
+            self.lock = self.threading.RLock()
+            self.atexit.register(self.close)
+
+        def write(self, mode, content):
+            if (isinstance(content, self.BASESTRING_TYPES) and
+                    isinstance(content, self.TEXT_TYPES)):
+                content = content.encode('utf-8')
+            with self.lock:
+                if 'a' not in mode:
+                    # Overwriting makes no sense for a buffer; write through.
+                    self.flush()
+                    self.buffer, self.size = [], 0
+                    try:
+                        self.os.ftruncate(self.get_fd(), 0)
+                    except (IOError, OSError):
+                        pass
+                self.buffer.append(content)
+                self.size += len(content)
+                if self.size >= self.max_size or not self.max_delay:
+                    self.flush()
+                elif self.timer is None:
+                    self.timer = self.threading.Timer(
+                        self.max_delay, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+        def get_fd(self):
+            """Gets a descriptor for the file, reopening it if the file has
+            been deleted or replaced (e.g. rotated) since it was opened."""
+            try:
+                inode = self.os.stat(self.path).st_ino
+            except OSError:
+                inode = None
+            if self.fd is None or inode != self.inode:
+                if self.fd is not None:
+                    self.os.close(self.fd)
+                    self.fd = None
+                flags = self.os.O_WRONLY | self.os.O_APPEND | self.os.O_CREAT
+                self.fd = self.os.open(self.path, flags, 438)  # 0666
+                self.inode = self.os.fstat(self.fd).st_ino
+            return self.fd
+
+        def flush(self):
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.buffer:
+                    return
+                data = b''.join(self.buffer)
+                self.buffer, self.size = [], 0
+                try:
+                    self.append(self.get_fd(), data)
+                except (IOError, OSError):
+                    pass
+
+        def append(self, fd, data):
+            """Appends data to the file so that it doesn't get interleaved
+            with output from other processes.  A single write() of at most
+            PIPE_BUF bytes to a file opened with O_APPEND is atomic; anything
+            longer is written while holding an advisory lock on the file."""
+            locked = len(data) > self.PIPE_BUF and self.fcntl
+            if locked:
+                self.fcntl.flock(fd, self.fcntl.LOCK_EX)
+            try:
+                while data:
+                    data = data[self.os.write(fd, data):]
+            finally:
+                if locked:
+                    self.fcntl.flock(fd, self.fcntl.LOCK_UN)
+
+        def after_fork(self):
+            """Discards state inherited from the parent in a child process
+            (the parent still owns, and will write, the buffered output)."""
+            self.lock = self.threading.RLock()
+            self.buffer, self.size = [], 0
+            self.timer = None
+
+        def close(self):
+            with self.lock:
+                self.flush()
+                if self.fd is not None:
+                    self.os.close(self.fd)
+                    self.fd = None
+
+    class RotatingFileWriter(object):
+        """Wraps a file writer, and rotates its file once it has grown past
+        max_bytes or is older than max_age seconds: path.1 becomes path.2
+        and so on, up to path.<backups>, and the file becomes path.1 (which
+        is gzipped on another thread, with compress).  The writer then
+        starts a new file at the same path, so "tail -F" keeps following.
+
+        The size is tracked by counting what goes through the writer, not
+        with a stat on every write; processes sharing a log each count only
+        their own output."""
+        import atexit
+        import os
+        import threading
+        import time
+        gzip = LazyModule('gzip')
+        shutil = LazyModule('shutil')
+
+        # For portably converting strings between python2 and python3
+        BASESTRING_TYPES = BASESTRING_TYPES
+        TEXT_TYPES = TEXT_TYPES
+
+        def __init__(self, file_writer, max_bytes=None, max_age=None,
+                     backups=5, compress=False):
+            self.file_writer = file_writer
+            self.max_bytes = max_bytes
+            self.max_age = max_age
+            self.backups = backups
+            self.compress = compress
+            self.compressor = None  # the thread gzipping path.1, if any
+            self.start()
+            self.atexit.register(self.wait)
+
+        @property
+        def path(self):
+            return self.file_writer.path
+
+        @path.setter
+        def path(self, path):
+            self.file_writer.path = path
+            self.start()
+
+        def start(self):
+            """Starts counting from the current size of the file."""
+            try:
+                self.size = self.os.path.getsize(self.path)
+            except OSError:
+                self.size = 0
+            self.start_time = self.time.time()
+
+        def write(self, mode, content):
+            self.file_writer.write(mode, content)
+            if 'a' not in mode:
+                self.size = 0
+            if (isinstance(content, self.BASESTRING_TYPES) and
+                    isinstance(content, self.TEXT_TYPES)):
+                content = content.encode('utf-8')  # count bytes, not chars
+            self.size += len(content)
+            if (self.max_bytes is not None and self.size >= self.max_bytes or
+                    self.max_age is not None and
+                    self.time.time() - self.start_time >= self.max_age):
+                self.rotate()
+
+        def rotate(self):
+            self.file_writer.flush()
+            self.wait()  # the compressor has to finish with path.1 first
+            path = self.path
+            for i in range(self.backups, 0, -1):
+                for suffix in ['', '.gz']:
+                    old = '%s.%d%s' % (path, i, suffix)
+                    new = '%s.%d%s' % (path, i + 1, suffix)
+                    try:
+                        if i == self.backups:
+                            self.os.remove(old)
+                        else:
+                            self.os.rename(old, new)
+                    except OSError:
+                        pass
+            try:
+                if self.backups:
+                    self.os.rename(path, path + '.1')
+                else:
+                    self.os.remove(path)
+            except OSError:
+                pass
+            self.start()
+            if self.compress and self.backups:
+                self.compressor = self.threading.Thread(
+                    target=self.gzip_file, args=(path + '.1',),
+                    name='q compressor')
+                self.compressor.daemon = True
+                self.compressor.start()
+
+        def gzip_file(self, path):
+            try:
+                with open(path, 'rb') as file:
+                    with self.gzip.open(path + '.gz', 'wb') as gz:
+                        self.shutil.copyfileobj(file, gz)
+                self.os.remove(path)
+            except (IOError, OSError):
+                pass
+
+        def flush(self):
+            self.file_writer.flush()
+
+        def after_fork(self):
+            if hasattr(self.file_writer, 'after_fork'):
+                self.file_writer.after_fork()
+            self.compressor = None  # it only runs in the parent
+
+        def wait(self):
+            """Waits for the compressor, if it's running, to finish."""
+            if self.compressor is not None:
+                self.compressor.join()
+                self.compressor = None
+
+        def close(self):
+            self.wait()
+            self.file_writer.close()
+
+    class SocketWriter(object):
+        """An object that streams the log to a collector (see Q.Collector)
+        over a Unix domain or TCP socket.  Writes never block: they are
+        queued and sent by a daemon thread, which batches them, keeps the
+        connection open, and reconnects with exponential backoff when it
+        can't get through.  Each write goes out as one frame (its length in
+        4 big-endian bytes, then its bytes), so records are never split.
+        Once max_pending bytes are waiting, further writes are dropped and
+        counted in self.dropped.  q's Writer closes it at exit, once the
+        other at-exit handlers have had their say."""
+        import collections
+        import threading
+        socket = LazyModule('socket')
+        struct = LazyModule('struct')
+
+        # For portably converting strings between python2 and python3
+        BASESTRING_TYPES = BASESTRING_TYPES
+        TEXT_TYPES = TEXT_TYPES
+
+        MIN_BACKOFF = 0.05
+        MAX_BACKOFF = 5.0
+
+        def __init__(self, family, address, max_size=65536, max_delay=0.05,
+                     max_pending=1 << 22, timeout=1.0):
+            self.family = family
+            self.address = address
+            self.max_size = max_size  # the most to send at once
+            self.max_delay = max_delay  # how long to wait for more to send
+            self.max_pending = max_pending
+            self.timeout = timeout  # for sending, and waiting in flush()
+            self.frames = self.collections.deque()
+            self.pending = 0
+            self.dropped = 0
+            self.sock = None
+            self.backoff = self.MIN_BACKOFF
+            self.closed = False
+            self.start()
+
+        def start(self):
+            self.lock = self.threading.Lock()
+            self.wakeup = self.threading.Event()  # there's something to send
+            self.hurry = self.threading.Event()  # send it now
+            self.retry = self.threading.Event()  # stop backing off
+            self.idle = self.threading.Event()  # everything has been sent
+            self.idle.set()
+            self.thread = self.threading.Thread(
+                target=self.run, name='q sender')
+            self.thread.daemon = True
+            self.thread.start()
+
+        def write(self, mode, content):
+            if (isinstance(content, self.BASESTRING_TYPES) and
+                    isinstance(content, self.TEXT_TYPES)):
+                content = content.encode('utf-8')
+            with self.lock:
+                if (self.closed or
+                        self.pending + len(content) > self.max_pending):
+                    self.dropped += 1
+                    return
+                self.frames.append(content)
+                self.pending += len(content)
+                self.idle.clear()
+                if self.pending >= self.max_size:
+                    self.hurry.set()
+            self.wakeup.set()
+
+        def run(self):
+            while not self.closed:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                self.hurry.wait(self.max_delay)  # let small writes pile up
+                while self.frames:
+                    self.hurry.clear()
+                    if not self.send():
+                        if self.closed:
+                            return
+                        self.retry.wait(self.backoff)
+                        self.retry.clear()
+                        self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+                with self.lock:
+                    if not self.frames:
+                        self.idle.set()
+
+        def send(self):
+            """Sends a batch of frames, connecting first if need be.  Returns
+            whether it got through."""
+            if self.sock is None:
+                sock = self.socket.socket(self.family, self.socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.address)
+                except (IOError, OSError):
+                    sock.close()
+                    return False
+                self.sock = sock
+                self.backoff = self.MIN_BACKOFF
+            with self.lock:
+                batch, size = [], 0
+                while self.frames and size < self.max_size:
+                    content = self.frames.popleft()
+                    batch.append(content)
+                    size += len(content)
+                self.pending -= size
+            data = b''.join([self.struct.pack('>I', len(content)) + content
+                             for content in batch])
+            try:
+                self.sock.sendall(data)
+            except (IOError, OSError):
+                # The collector drops any partial frame, so send the whole
+                # batch again once it's back.
+                self.sock.close()
+                self.sock = None
+                with self.lock:
+                    self.frames.extendleft(reversed(batch))
+                    self.pending += size
+                return False
+            return True
+
+        def flush(self):
+            """Waits up to self.timeout seconds for everything written so far
+            to be sent."""
+            if not self.idle.is_set() and not self.closed:
+                self.hurry.set()
+                self.retry.set()
+                self.wakeup.set()
+                self.idle.wait(self.timeout)
+
+        def after_fork(self):
+            """Starts over in a child process, which gets its own connection
+            and sending thread (the parent sends what it had queued)."""
+            if self.sock is not None:
+                self.sock.close()  # only the child's copy of the descriptor
+                self.sock = None
+            self.frames.clear()
+            self.pending = 0
+            if not self.closed:
+                self.start()
+
+        def close(self):
+            if not self.closed:
+                self.flush()
+                self.closed = True
+                self.hurry.set()
+                self.retry.set()
+                self.wakeup.set()
+                self.thread.join(self.timeout)
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+
+    class Collector(object):
+        """Listens on a Unix domain or TCP socket for the frames that
+        SocketWriters send, from any number of processes, and appends each
+        one, whole, to the file at path, so that "tail -f" shows them all."""
+        import os
+        select = LazyModule('select')
+        socket = LazyModule('socket')
+        struct = LazyModule('struct')
+
+        def __init__(self, family, address, path):
+            self.path = path
+            self.sock = self.socket.socket(family, self.socket.SOCK_STREAM)
+            if family == getattr(self.socket, 'AF_UNIX', None):
+                try:
+                    self.os.remove(address)  # left over from an earlier run
+                except OSError:
+                    pass
+            else:
+                self.sock.setsockopt(
+                    self.socket.SOL_SOCKET, self.socket.SO_REUSEADDR, 1)
+            self.sock.bind(address)
+            self.sock.listen(64)
+            self.address = self.sock.getsockname()
+            self.buffers = {}  # connection -> bytes of an unfinished frame
+            self.running = False
+
+        def run(self, poll_interval=0.5):
+            """Collects frames until stop() is called."""
+            self.running = True
+            with open(self.path, 'ab') as file:
+                while self.running:
+                    readable = self.select.select(
+                        [self.sock] + list(self.buffers), [], [],
+                        poll_interval)[0]
+                    frames = []
+                    for sock in readable:
+                        if sock is self.sock:
+                            connection = self.sock.accept()[0]
+                            self.buffers[connection] = bytearray()
+                        else:
+                            self.receive(sock, frames)
+                    if frames:
+                        file.write(b''.join(frames))
+                        file.flush()
+
+        def receive(self, sock, frames):
+            """Reads from a connection, adding the frames it completes to the
+            list frames."""
+            try:
+                data = sock.recv(65536)
+            except (IOError, OSError):
+                data = b''
+            if not data:
+                sock.close()
+                del self.buffers[sock]
+                return
+            buffer = self.buffers[sock]
+            buffer.extend(data)
+            offset = 0
+            while len(buffer) - offset >= 4:
+                size = self.struct.unpack_from('>I', buffer, offset)[0]
+                if len(buffer) - offset - 4 < size:
+                    break
+                frames.append(bytes(buffer[offset + 4:offset + 4 + size]))
+                offset += 4 + size
+            del buffer[:offset]
+
+        def stop(self):
+            self.running = False
+
+        def close(self):
+            for sock in [self.sock] + list(self.buffers):
+                sock.close()
+            self.buffers.clear()
+            if isinstance(self.address, str):  # a Unix domain socket
+                try:
+                    self.os.remove(self.address)
+                except OSError:
+                    pass
+
+    class SourceCache(object):
+        """Reads lines of source files faster than linecache: each file is
+        split into lines once (or, if it's big, indexed by line offsets),
+        and its modification time is checked at most once every
+        check_interval seconds.  Files are read into memory rather than
+        memory-mapped, since a mapped file that is truncated in the meantime
+        would crash the process (with SIGBUS) when the lost pages are read."""
+        import os
+        import time
+        tokenize = LazyModule('tokenize')  # for detecting source encodings
+
+        INDEX_SIZE = 1 << 20  # index files at least this big by line offsets
+
+        class SourceFile(object):
+            def __init__(self, mtime, data, encoding, index):
+                self.mtime = mtime
+                self.encoding = encoding
+                self.data = data
+                if not index:
+                    self.lines = data.split(b'\n')
+                    self.count = len(self.lines)
+                else:
+                    self.lines = None
+                    self.offsets = offsets = [0]
+                    pos = data.find(b'\n')
+                    while pos >= 0:
+                        offsets.append(pos + 1)
+                        pos = data.find(b'\n', pos + 1)
+                    offsets.append(len(data) + 1)
+                    self.count = len(offsets) - 1
+                if data[-1:] in (b'\n', b''):
+                    self.count -= 1  # nothing follows the last newline
+
+            def line(self, i):
+                """Gets line i (counting from 0), with a newline on the end."""
+                if self.lines is not None:
+                    line = self.lines[i]
+                else:
+                    line = self.data[self.offsets[i]:self.offsets[i + 1] - 1]
+                if self.encoding:
+                    line = line.decode(self.encoding, 'replace')
+                return line.rstrip('\r') + '\n'
+
+        def __init__(self, check_interval=1.0):
+            self.check_interval = check_interval
+            self.files = {}  # filename -> SourceFile
+            self.mtimes = {}  # filename -> (mtime, time when checked)
+
+        def get_mtime(self, filename):
+            """Gets the modification time of a source file, or None."""
+            now = self.time.time()
+            entry = self.mtimes.get(filename)
+            if entry and now - entry[1] < self.check_interval:
+                return entry[0]
+            try:
+                mtime = self.os.stat(filename).st_mtime
+            except (OSError, TypeError, ValueError):
+                mtime = None
+            self.mtimes[filename] = (mtime, now)
+            return mtime
+
+        def get_file(self, filename):
+            mtime = self.get_mtime(filename)
+            source = self.files.get(filename)
+            if source and source.mtime == mtime:
+                return source
+            self.files.pop(filename, None)
+            if mtime is None:
+                return None
+            try:
+                with open(filename, 'rb') as file:
+                    data = file.read()
+            except (IOError, OSError, ValueError):
+                return None
+            encoding = None
+            # Python 2 has no detect_encoding; there, lines stay as bytes.
+            detect_encoding = getattr(self.tokenize, 'detect_encoding', None)
+            if detect_encoding:
+                lines = iter(data[:1000].splitlines(True))
+                try:
+                    encoding, _ = detect_encoding(
+                        lambda: next(lines, b''))
+                except SyntaxError:
+                    return None
+            source = self.files[filename] = self.SourceFile(
+                mtime, data, encoding, len(data) >= self.INDEX_SIZE)
+            return source
+
+        def get_context(self, filename, lineno, context):
+            """Gets (lines, index) for `context` lines of source centered on
+            line number lineno, the way inspect.getframeinfo does, or None if
+            the source is unavailable."""
+            source = self.get_file(filename)
+            if source is None or not 0 < lineno <= source.count:
+                return None
+            start = lineno - 1 - context // 2
+            start = max(0, min(start, source.count - context))
+            end = min(start + context, source.count)
+            lines = [source.line(i) for i in range(start, end)]
+            return lines, lineno - 1 - start
+
+    class SpillStore(object):
+        """Saves big strings to files for later examination.  Files are named
+        by a hash of their contents, so each distinct string is written only
+        once, and the least recently used ones are deleted to stay within
+        max_bytes and max_files.  In pack mode, strings are appended to one
+        blob file instead, and found by offset and length."""
+        import collections
+        import mmap
+        import os
+        import threading
+        hashlib = LazyModule('hashlib')
+
+        # For portably converting strings between python2 and python3
+        TEXT_TYPES = TEXT_TYPES
+        COPY_SIZE = 1 << 20  # bytes to copy at a time into the blob file
+
+        def __init__(self, prefix, file_writer,
+                     max_bytes=100 << 20, max_files=1000, pack=False):
+            self.prefix = prefix
+            self.file_writer = file_writer  # the FileWriter class
+            self.max_bytes = max_bytes
+            self.max_files = max_files
+            self.pack = pack
+            self.files = self.collections.OrderedDict()  # path -> size
+            self.total = 0
+            self.blob_path = prefix + '.blob'
+            self.blob_index = {}  # digest -> (offset, length)
+            self.blob_size = None
+            self.lock = self.threading.RLock()
+
+        def store(self, data):
+            """Saves data (a bytes object) and returns a file:// URL for it."""
+            digest = self.hashlib.sha1(data).hexdigest()
+            with self.lock:
+                if self.pack:
+                    return self.store_packed(
+                        digest, len(data),
+                        lambda: self.file_writer(self.blob_path).write(
+                            'a', data))
+                path = self.prefix + digest[:16] + '.txt'
+                if path in self.files and self.os.path.exists(path):
+                    self.files[path] = self.files.pop(path)  # recently used
+                else:
+                    self.file_writer(path).write('w', data)
+                    self.add_file(path, len(data))
+                return 'file://' + path
+
+        def store_stream(self, generate):
+            """Saves the data that generate(write) passes to write, in chunks
+            of text or bytes, and returns a file:// URL for it, or None if it
+            couldn't be saved.  The chunks go straight to a temporary file,
+            so the data is never all in memory; the file is then renamed (or,
+            in pack mode, copied) into place."""
+            temp_path = '%s.%d.%d.tmp' % (
+                self.prefix, self.os.getpid(),
+                self.threading.current_thread().ident)
+            temp = self.file_writer(temp_path)
+            temp.write('w', b'')
+            sha1 = self.hashlib.sha1()
+            size = [0]
+
+            def write(data):
+                if isinstance(data, self.TEXT_TYPES):
+                    data = data.encode('utf-8')
+                sha1.update(data)
+                size[0] += len(data)
+                temp.write('a', data)
+
+            try:
+                generate(write)
+                digest = sha1.hexdigest()
+                with self.lock:
+                    if self.pack:
+                        return self.store_packed(digest, size[0], lambda: (
+                            self.copy_to_blob(temp_path)))
+                    path = self.prefix + digest[:16] + '.txt'
+                    if path in self.files and self.os.path.exists(path):
+                        self.files[path] = self.files.pop(path)  # just used
+                    else:
+                        self.os.rename(temp_path, path)
+                        self.add_file(path, size[0])
+                    return 'file://' + path
+            except (IOError, OSError):  # e.g. the directory isn't writable
+                return None
+            finally:
+                try:
+                    self.os.remove(temp_path)
+                except OSError:
+                    pass  # it was renamed into place, or never written
+
+        def add_file(self, path, size):
+            self.total += size - self.files.pop(path, 0)
+            self.files[path] = size
+            self.evict()
+
+        def copy_to_blob(self, path):
+            blob = self.file_writer(self.blob_path)
+            with open(path, 'rb') as file:
+                for data in iter(lambda: file.read(self.COPY_SIZE), b''):
+                    blob.write('a', data)
+
+        def evict(self):
+            # The newest file stays, even if it's over the budget by itself.
+            while len(self.files) > 1 and (
+                    len(self.files) > self.max_files or
+                    self.total > self.max_bytes):
+                path, size = self.files.popitem(last=False)
+                self.total -= size
+                try:
+                    self.os.remove(path)
+                except OSError:
+                    pass
+
+        def store_packed(self, digest, length, append):
+            """Calls append() to add length bytes to the blob file, unless
+            data with the same digest is already there."""
+            if digest not in self.blob_index:
+                if self.blob_size is None:
+                    try:
+                        self.blob_size = self.os.path.getsize(self.blob_path)
+                    except OSError:
+                        self.blob_size = 0
+                if self.blob_size and (
+                        self.blob_size + length > self.max_bytes):
+                    # Start over rather than grow past the budget.  URLs for
+                    # the old blob include the hash, so read() can tell that
+                    # they no longer resolve.
+                    for path in [self.blob_path, self.blob_path + '.idx']:
+                        try:
+                            self.os.remove(path)
+                        except OSError:
+                            pass
+                    self.blob_index.clear()
+                    self.blob_size = 0
+                append()
+                self.blob_index[digest] = (self.blob_size, length)
+                self.file_writer(self.blob_path + '.idx').write(
+                    'a', '%s %d %d\n' % (digest, self.blob_size, length))
+                self.blob_size += length
+            offset, length = self.blob_index[digest]
+            return 'file://%s#sha1=%s&offset=%d&length=%d' % (
+                self.blob_path, digest, offset, length)
+
+        def read(self, url):
+            """Reads the data saved at a URL that store() returned, or returns
+            None if it is gone."""
+            path, _, fragment = url[len('file://'):].partition('#')
+            try:
+                with open(path, 'rb') as file:
+                    if not fragment:
+                        return file.read()
+                    params = dict(p.split('=') for p in fragment.split('&'))
+                    offset = int(params['offset'])
+                    length = int(params['length'])
+                    view = self.mmap.mmap(
+                        file.fileno(), 0, access=self.mmap.ACCESS_READ)
+                    try:
+                        data = view[offset:offset + length]
+                    finally:
+                        view.close()
+            except (IOError, OSError, KeyError, ValueError):
+                return None
+            if self.hashlib.sha1(data).hexdigest() == params.get('sha1'):
+                return data
+
     class Writer:
         """Abstract away the output pipe, timestamping, and color support."""
+        import atexit
+        import collections
+        import os
+        import sys
+        import threading
+        json = LazyModule('json')  # only for JSON Lines output
 
         NORMAL, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN = ESCAPE_SEQUENCES
 
@@ -160,32 +955,272 @@ class Q(object):
             self.file_writer = file_writer
             self.gap_seconds = 2
             self.time = time  # the 'time' module (needed because no globals)
+            self.monotonic = getattr(time, 'monotonic', time.time)
             self.start_time = self.time.time()
             self.last_write = 0
-
-        def write(self, chunks):
-            """Writes out a list of strings as a single timestamped unit."""
-            if not self.color:
-                chunks = [x for x in chunks if not x.startswith('\x1b')]
-            content = ''.join(chunks)
-
-            now = self.time.time()
+            # Turns record dicts into lists of strings for the text log.
+            self.render = None
+            # Whether to write the text log, and where to write records as
+            # JSON Lines (if anywhere).
+            self.text = True
+            self.record_writer = None
+            # Records are tagged with the thread or asyncio task that wrote
+            # them, except in the main thread outside of any task.
+            self.main_thread = getattr(
+                self.threading, 'main_thread', self.threading.current_thread)()
+            # Whether to tag every record with the process ID.
+            self.show_pid = False
+            self.lock = self.threading.RLock()
+            # When writing in the background, records wait in this queue.
+            self.queue = None
+            self.max_queue = 10000
+            self.dropped = 0
+            self.reported_dropped = 0
+            self.thread = None
+            self.wakeup = self.threading.Event()
+            self.atexit.register(self.close)
+            # In flight recorder mode, the latest records are kept here
+            # instead of being written out, until they are dumped.
+            self.ring = None
+
+        def write(self, item, now=None, tag=None):
+            """Writes out a record as a single timestamped unit.  The record
+            can be a Stanza, a list of strings, a dict (see Q.render_record),
+            or a function that returns one of these.  The time and tag default
+            to the current ones."""
+            now = now or self.time.time()
+            if tag is None:
+                tag = self.get_tag()
+            stamp = self.record_writer and self.get_stamp()
+            ring = self.ring
+            if ring is not None:
+                ring.append((now, tag, stamp, item))
+                return
+            queue = self.queue
+            if queue is None:
+                if callable(item):
+                    item = item()
+                with self.lock:
+                    self.write_items([(now, tag, stamp, item)])
+            elif len(queue) < self.max_queue:
+                queue.append((now, tag, stamp, item))
+                self.wakeup.set()
+            else:
+                self.dropped += 1
+
+        def get_tag(self):
+            """Gets the name of the current thread and asyncio task, if any."""
+            names = []
+            if self.show_pid:
+                names.append('pid %d' % self.os.getpid())
+            thread = self.threading.current_thread()
+            if thread is not self.main_thread:
+                names.append(thread.name)
+            asyncio = self.sys.modules.get('asyncio')
+            if asyncio:
+                try:
+                    task = asyncio.current_task()
+                except (AttributeError, RuntimeError):
+                    task = None
+                if task is not None:
+                    names.append(getattr(task, 'get_name', lambda: (
+                        'Task-%x' % id(task)))())
+            return ' '.join(names)
+
+        def get_stamp(self):
+            """Gets the details of the writing process and thread that go
+            into structured records."""
+            return {'monotonic': self.monotonic(), 'pid': self.os.getpid(),
+                    'tid': self.threading.current_thread().ident}
+
+        def write_items(self, items):
+            """Formats and writes out a batch of (now, tag, stamp, item)
+            tuples, with a single write to each output.  The text of the
+            whole batch is built from one list of pieces, and is encoded all
+            at once by the file writer."""
+            pieces, lines = [], []
+            for now, tag, stamp, item in items:
+                self.format(now, tag, stamp, item, pieces, lines)
+            text = ''.join(pieces)
+            del pieces[:]  # drop the indented copies of multi-line chunks
+            if text:
+                self.file_writer.write('a', text)
+            if lines and self.record_writer:
+                self.record_writer.write('a', ''.join(lines))
+
+        def format(self, now, tag, stamp, item, pieces, lines):
+            """Formats a record, adding the pieces of its text for the log to
+            the list pieces and, if stamp is given, a line of JSON to the list
+            lines."""
+            if callable(item):  # a record whose rendering was put off
+                item = item()
+            record = None
+            if isinstance(item, dict):
+                record, item = item, self.render(item)
+            if isinstance(item, list):  # not a Stanza; find the escapes
+                chunks = item
+                escapes = [i for i, x in enumerate(chunks)
+                           if x.startswith('\x1b')]
+                breaks = [i for i, x in enumerate(chunks) if '\n' in x]
+            else:
+                chunks = item.chunks
+                escapes, breaks = item.escapes, item.breaks
+            if self.text:
+                self.format_text(pieces, now, tag, chunks, escapes, breaks)
+            if stamp:
+                lines.append(self.format_json(
+                    now, tag, stamp, chunks, escapes, record))
+
+        def format_text(self, pieces, now, tag, chunks, escapes, breaks):
+            """Formats a list of strings as a single timestamped unit, given
+            the indexes of the escape sequences and of the strings with line
+            breaks among them, and adds it to the list pieces."""
             prefix = '%4.1fs ' % ((now - self.start_time) % 100)
-            indent = ' ' * len(prefix)
+            if tag:
+                prefix += '[' + tag + '] '
+            indent = '\n' + ' ' * len(prefix)
             if self.color:
                 prefix = self.YELLOW + prefix + self.NORMAL
             if now - self.last_write >= self.gap_seconds:
                 prefix = '\n' + prefix
             self.last_write = now
 
-            output = prefix + content.replace('\n', '\n' + indent)
-            self.file_writer.write('a', output + '\n')
+            pieces.append(prefix)
+            start = len(pieces)
+            pieces.extend(chunks)
+            if not self.color:
+                for i in escapes:
+                    pieces[start + i] = ''
+            for i in breaks:
+                pieces[start + i] = pieces[start + i].replace('\n', indent)
+            pieces.append('\n')
+
+        def format_json(self, now, tag, stamp, chunks, escapes, record):
+            """Formats a record as a line of JSON.  Records that were written
+            as plain lists of strings become records of kind 'note'."""
+            if record is None:
+                chunks = list(chunks)
+                for i in escapes:
+                    chunks[i] = ''
+                record = {'kind': 'note', 'text': ''.join(chunks)}
+            record = dict(record, time=now, **stamp)
+            if tag:
+                record['tag'] = tag
+            return self.json.dumps(record, sort_keys=True) + '\n'
+
+        def start_thread(self, max_queue=10000):
+            """Starts formatting and writing records on a daemon thread.  At
+            most max_queue records can wait; any more are dropped and counted
+            in self.dropped."""
+            self.max_queue = max_queue
+            if self.queue is None:
+                self.queue = self.collections.deque()
+                self.thread = self.threading.Thread(
+                    target=self.run, args=(self.queue,), name='q writer')
+                self.thread.daemon = True
+                self.thread.start()
+
+        def stop_thread(self):
+            """Writes out everything in the queue and stops the thread."""
+            queue, self.queue = self.queue, None
+            if queue is not None:
+                self.wakeup.set()
+                self.thread.join()
+                self.thread = None
+            self.file_writer.flush()
+            if self.record_writer:
+                self.record_writer.flush()
+
+        def close(self):
+            """Writes out everything and closes the log at exit.  It's
+            registered before q's other at-exit handlers, so it runs after
+            them, and what they write still gets out."""
+            self.stop_thread()
+            self.file_writer.close()
+            if self.record_writer:
+                self.record_writer.close()
+
+        def start_recording(self, size=10000):
+            """Keeps the last size records in memory instead of writing them
+            out, until dump() is called."""
+            self.ring = self.collections.deque(self.ring or (), maxlen=size)
+
+        def stop_recording(self):
+            """Writes out the records in memory and goes back to writing
+            records out as they come."""
+            ring, self.ring = self.ring, None
+            self.dump(ring)
+
+        def dump(self, ring=None):
+            """Writes out and forgets the records kept in memory."""
+            ring = ring or self.ring
+            if not ring:
+                return
+            with self.lock:
+                items = []
+                while ring:
+                    items.append(ring.popleft())
+                message = 'q: dumping the last %d records' % len(items)
+                items.insert(0, (
+                    self.time.time(), '', self.record_writer and
+                    self.get_stamp(), [self.MAGENTA, message, self.NORMAL]))
+                self.write_items(items)
+            self.file_writer.flush()
+            if self.record_writer:
+                self.record_writer.flush()
+
+        def after_fork(self):
+            """Resets state that can't be shared with a parent process in a
+            child process, right after a fork."""
+            self.lock = self.threading.RLock()
+            self.wakeup = self.threading.Event()
+            self.last_write = 0
+            if self.ring:
+                self.ring.clear()  # the parent will dump these
+            for writer in [self.file_writer, self.record_writer]:
+                if hasattr(writer, 'after_fork'):
+                    writer.after_fork()
+            if self.queue is not None:
+                # The writer thread didn't survive the fork, and the parent
+                # will write out the records that were waiting for it.
+                self.queue = None
+                self.start_thread(self.max_queue)
+
+        def run(self, queue):
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                self.drain(queue)
+                if self.queue is not queue:
+                    self.drain(queue)
+                    return
+
+        def drain(self, queue, batch_size=1000):
+            """Writes out queued records, several at a time."""
+            while queue:
+                items = []
+                while queue and len(items) < batch_size:
+                    items.append(queue.popleft())
+                with self.lock:
+                    if self.dropped > self.reported_dropped:
+                        dropped = self.dropped - self.reported_dropped
+                        self.reported_dropped = self.dropped
+                        items.append((
+                            self.time.time(), '',
+                            self.record_writer and self.get_stamp(),
+                            [self.RED, 'q: dropped %d records because the '
+                             'queue was full' % dropped, self.NORMAL]))
+                    self.write_items(items)
 
     class Stanza:
-        """Abstract away indentation and line-wrapping."""
+        """Abstract away indentation and line-wrapping.  The positions of the
+        color escape sequences and line breaks among the chunks are noted as
+        they are added, so the writer doesn't have to search for them."""
 
         def __init__(self, indent=0, width=80 - 7):
             self.chunks = [' ' * indent]
+            self.escapes = []  # indexes of chunks that are escape sequences
+            self.breaks = []  # indexes of chunks that contain newlines
             self.indent = indent
             self.column = indent
             self.width = width
@@ -196,24 +1231,1030 @@ class Q(object):
 
         def add(self, items, sep='', wrap=True):
             """Adds a list of strings that are to be printed on one line."""
-            items = list(map(str, items))
-            size = sum([len(x) for x in items if not x.startswith('\x1b')])
+            chunks = self.chunks
+            start = len(chunks)
+            chunks.append(sep)
+            size = 0
+            for item in items:
+                if not isinstance(item, str):
+                    item = str(item)
+                if item.startswith('\x1b'):
+                    self.escapes.append(len(chunks))
+                else:
+                    size += len(item)
+                    if '\n' in item:
+                        self.breaks.append(len(chunks))
+                chunks.append(item)
             if (wrap and self.column > self.indent and
                     self.column + len(sep) + size > self.width):
-                self.chunks.append(sep.rstrip() + '\n' + ' ' * self.indent)
+                chunks[start] = sep.rstrip() + '\n' + ' ' * self.indent
+                self.breaks.append(start)
                 self.column = self.indent
             else:
-                self.chunks.append(sep)
                 self.column += len(sep)
-            self.chunks.extend(items)
             self.column += size
 
+    class Repr(object):
+        """Makes reprs within a budget of max_length characters.  Once the
+        budget runs out, it stops descending into containers and ends the
+        repr with '...', so a huge value costs no more than a small one.
+        Containers are also cut off after max_items items (max_dict_items
+        for mappings) or max_level levels of nesting, and strings and other
+        reprs after max_string characters, if these are set.  The formatter
+        for each type is looked up once."""
+        import collections
+        heapq = LazyModule('heapq')  # for the most common items of a Counter
+        re = LazyModule('re')  # for stripping ids
+
+        # Containers that get formatted item by item, with their brackets.
+        BRACKETS = {
+            list: ('[', ']'),
+            tuple: ('(', ')'),
+            set: tuple(repr(set([0])).split('0')),  # {0} or set([0])
+            frozenset: tuple(repr(frozenset([0])).split('0')),
+        }
+        FORMATTERS = {
+            collections.Counter: 'format_counter',
+            collections.OrderedDict: 'format_ordered_dict',
+            collections.defaultdict: 'format_defaultdict',
+            collections.deque: 'format_deque',
+            bool: 'format_atom',
+            bytearray: 'format_str',
+            bytes: 'format_str',
+            complex: 'format_atom',
+            dict: 'format_dict',
+            float: 'format_atom',
+            frozenset: 'format_items',
+            list: 'format_items',
+            set: 'format_items',
+            str: 'format_str',
+            tuple: 'format_items',
+            type(None): 'format_atom',
+        }
+        FORMATTERS.update(dict.fromkeys(INTEGER_TYPES, 'format_atom'))
+        FORMATTERS.update(dict.fromkeys(TEXT_TYPES, 'format_str'))
+        # Subclasses of these are formatted the same way as long as they
+        # don't have their own __repr__.
+        SUBCLASSABLE = (
+            collections.Counter, collections.OrderedDict,
+            collections.defaultdict, collections.deque,
+            dict, list, tuple, bytes, str) + TEXT_TYPES
+        # Before Python 3.12, an OrderedDict shows as a list of pairs.
+        ORDERED_PAIRS = '[' in repr(collections.OrderedDict([(0, 0)]))
+
+        # numpy arrays bigger than this are summarized by their first few
+        # items, shape and dtype.
+        ARRAY_SIZE = 100
+        ARRAY_ITEMS = 6
+
+        class Output(object):
+            """The pieces of one repr, and how much of its budget is left."""
+            __slots__ = ['pieces', 'left', 'active', 'truncated']
+
+            def __init__(self, left):
+                self.pieces = []
+                self.left = left
+                self.active = set()  # ids of the containers being formatted
+                self.truncated = False
+
+            def add(self, text):
+                if len(text) > self.left:
+                    text = text[:max(self.left, 0)]
+                    self.truncated = True
+                self.pieces.append(text)
+                self.left -= len(text)
+
+        class StreamOutput(Output):
+            """An Output that passes its pieces to write() in chunks of about
+            chunk_size characters, instead of keeping them."""
+            __slots__ = ['write', 'chunk_size', 'pending']
+
+            def __init__(self, left, write, chunk_size):
+                self.pieces = []
+                self.left = left
+                self.active = set()
+                self.truncated = False
+                self.write = write
+                self.chunk_size = chunk_size
+                self.pending = 0
+
+            def add(self, text):
+                if len(text) > self.left:
+                    text = text[:max(self.left, 0)]
+                    self.truncated = True
+                self.pieces.append(text)
+                self.left -= len(text)
+                self.pending += len(text)
+                if self.pending >= self.chunk_size:
+                    self.flush()
+
+            def flush(self):
+                self.write(''.join(self.pieces))
+                self.pieces = []
+                self.pending = 0
+
+        def __init__(self, max_length, max_items=None, max_level=None,
+                     max_string=None, max_dict_items=None):
+            self.max_length = max_length
+            self.max_items = max_items
+            self.max_dict_items = max_dict_items
+            self.max_level = max_level
+            self.max_string = max_string
+            self.formatters = {}  # the formatter for each type seen so far
+            self.brackets = {}  # the brackets for each container type
+
+        def repr(self, value, max_length=None):
+            if max_length is None or max_length > self.max_length:
+                max_length = self.max_length
+            out = self.Output(max_length)
+            try:
+                self.format(value, out, 0)
+            except Exception:  # e.g. a dict changed size while we read it
+                out = self.Output(max_length)
+                self.format_other(value, out, 0)
+            text = ''.join(out.pieces)
+            return out.truncated and text + '...' or text
+
+        def stream(self, value, write, max_length, chunk_size=1 << 14):
+            """Passes the repr of a value to write() in chunks as it is made,
+            for values whose reprs are too big to build in memory."""
+            out = self.StreamOutput(max_length, write, chunk_size)
+            try:
+                self.format(value, out, 0)
+            except Exception:  # e.g. a dict changed size while we read it
+                out.truncated = True
+            out.flush()
+            if out.truncated:
+                write('...')
+
+        def format(self, value, out, level):
+            cls = type(value)
+            formatter = self.formatters.get(cls) or self.get_formatter(cls)
+            formatter(value, out, level)
+
+        def get_formatter(self, cls):
+            base = cls
+            if cls not in self.FORMATTERS:
+                for base in self.SUBCLASSABLE:
+                    if issubclass(cls, base) and cls.__repr__ is base.__repr__:
+                        break
+                else:
+                    base = None
+            if base in self.BRACKETS:
+                self.brackets[cls] = self.BRACKETS[base]
+            if base is not None:
+                name = self.FORMATTERS[base]
+            elif cls.__name__ == 'ndarray' and cls.__module__ == 'numpy':
+                name = 'format_ndarray'
+            elif cls.__name__ == 'array' and cls.__module__ == 'array':
+                name = 'format_array'
+            else:
+                name = 'format_other'
+            formatter = self.formatters[cls] = getattr(self, name)
+            return formatter
+
+        def format_atom(self, value, out, level):
+            try:
+                out.add(repr(value))
+            except ValueError:  # an int too big to convert to decimal
+                out.add('<%s with %d bits>' % (
+                    type(value).__name__, value.bit_length()))
+
+        def format_other(self, value, out, level):
+            try:
+                size = hasattr(value, '__iter__') and len(value)
+            except Exception:
+                size = None
+            if size and size > out.left:
+                # A container with its own repr, and more items than could
+                # fit: don't build the whole repr just to throw it away.
+                out.add('<%s len=%d>' % (type(value).__name__, size))
+                return
+            try:
+                text = repr(value)
+            except Exception:
+                text = '<%s instance>' % type(value).__name__
+            if ' at 0x' in text:  # drop the address, as pydoc does
+                text = self.re.sub(
+                    r' at 0x[0-9a-fA-F]{6,16}(>+)$', r'\1', text)
+            if self.max_string is not None and len(text) > self.max_string:
+                text = text[:self.max_string] + '...'
+            out.add(text)
+
+        def format_str(self, value, out, level):
+            # Only the part of the string that fits in the budget is repr'd.
+            limit = out.left
+            if self.max_string is not None and self.max_string < limit:
+                limit = self.max_string
+            cut = len(value) > limit
+            if cut:
+                value = value[:limit]
+            text = repr(value)
+            # Like pydoc, show strings with backslashes as raw strings when
+            # they have no other escapes.
+            if (text[0] in '\'"' and isinstance(value, str) and
+                    '\\' in value and '\\' not in text.replace('\\\\', '')):
+                text = 'r' + text[0] + value + text[0]
+            out.add(text)
+            if cut and out.left > 0:
+                out.add('...')
+
+        def format_items(self, value, out, level):
+            start, end = self.brackets[type(value)]
+            if not value:
+                out.add(repr(value))
+                return
+            self.format_sequence(value, out, level, start, end, value)
+
+        def format_deque(self, value, out, level):
+            if not value:
+                out.add(repr(value))
+                return
+            end = '])'
+            if value.maxlen is not None:
+                end = '], maxlen=%d)' % value.maxlen
+            self.format_sequence(
+                value, out, level, type(value).__name__ + '([', end, value)
+
+        def format_array(self, value, out, level):
+            if not value or value.typecode in 'uw':  # empty, or a string
+                return self.format_other(value, out, level)
+            self.format_sequence(value, out, level, '%s(%r, [' % (
+                type(value).__name__, value.typecode), '])', value)
+
+        def format_sequence(self, value, out, level, start, end, items):
+            """Formats the items of a container, one by one, between start
+            and end, until the budget or max_items runs out."""
+            if id(value) in out.active or (
+                    self.max_level is not None and level >= self.max_level):
+                out.add(start + '...' + end)
+                return
+            out.active.add(id(value))
+            formatters = self.formatters
+            try:
+                out.add(start)
+                for i, item in enumerate(items):
+                    if i:
+                        out.add(', ')
+                    if out.left <= 0 or i == self.max_items:
+                        out.add('...')
+                        break
+                    cls = type(item)
+                    formatter = formatters.get(cls) or self.get_formatter(cls)
+                    formatter(item, out, level + 1)
+                if isinstance(value, tuple) and len(value) == 1:
+                    out.add(',')
+                out.add(end)
+            finally:
+                out.active.discard(id(value))
+
+        def format_dict(self, value, out, level):
+            if not value:
+                out.add(repr(value))
+                return
+            self.format_pairs(value, out, level, '{', '}',
+                              getattr(value, 'iteritems', value.items)())
+
+        def format_ordered_dict(self, value, out, level):
+            if not value:
+                out.add(repr(value))
+                return
+            name = type(value).__name__
+            items = getattr(value, 'iteritems', value.items)()
+            if self.ORDERED_PAIRS:
+                self.format_sequence(
+                    value, out, level, name + '([', '])', items)
+            else:
+                self.format_pairs(value, out, level, name + '({', '})', items)
+
+        def format_defaultdict(self, value, out, level):
+            if not value:
+                out.add(repr(value))
+                return
+            out.add(type(value).__name__ + '(')
+            self.format(value.default_factory, out, level + 1)
+            out.add(', ')
+            self.format_pairs(value, out, level, '{', '})',
+                              getattr(value, 'iteritems', value.items)())
+
+        def format_counter(self, value, out, level):
+            if not value:
+                out.add(repr(value))
+                return
+            # Most common first, as in Counter's repr, but only the keys
+            # that can fit are picked out (each takes at least 6 characters,
+            # as in "k: 1, "), and no list of (key, count) pairs is made.
+            count = out.left // 6 + 2
+            if self.max_dict_items is not None:
+                count = min(count, self.max_dict_items + 1)
+            try:
+                if count < len(value):
+                    keys = self.heapq.nlargest(
+                        count, value, key=value.__getitem__)
+                else:
+                    keys = sorted(value, key=value.__getitem__, reverse=True)
+            except TypeError:  # counts that can't be ordered
+                keys = value
+            self.format_pairs(value, out, level,
+                              type(value).__name__ + '({', '})',
+                              ((key, value[key]) for key in keys))
+
+        def format_pairs(self, value, out, level, start, end, items):
+            """Formats the (key, value) items of a mapping, like a dict,
+            between start and end, until the budget or max_dict_items runs
+            out."""
+            if id(value) in out.active or (
+                    self.max_level is not None and level >= self.max_level):
+                out.add(start + '...' + end)
+                return
+            out.active.add(id(value))
+            formatters = self.formatters
+            try:
+                out.add(start)
+                for i, (key, item) in enumerate(items):
+                    if i:
+                        out.add(', ')
+                    if out.left <= 0 or i == self.max_dict_items:
+                        out.add('...')
+                        break
+                    cls = type(key)
+                    formatter = formatters.get(cls) or self.get_formatter(cls)
+                    formatter(key, out, level + 1)
+                    out.add(': ')
+                    cls = type(item)
+                    formatter = formatters.get(cls) or self.get_formatter(cls)
+                    formatter(item, out, level + 1)
+                out.add(end)
+            finally:
+                out.active.discard(id(value))
+
+        def format_ndarray(self, value, out, level):
+            if value.size <= self.ARRAY_SIZE:
+                return self.format_other(value, out, level)
+            # Only the first few items are converted, not the whole array.
+            items = value.flat[:self.ARRAY_ITEMS].tolist()
+            out.add('array([%s, ...], shape=%r, dtype=%s)' % (
+                ', '.join(map(repr, items)), value.shape, value.dtype))
+
+    class LazyRepr(object):
+        """A value whose repr is rendered later, along with cheap metadata
+        about the value that is taken right away."""
+        __slots__ = ['value', 'type_name', 'length', 'id']
+
+        def __init__(self, value):
+            self.value = value
+            self.type_name = type(value).__name__
+            try:
+                self.length = len(value)
+            except Exception:
+                self.length = None
+            self.id = id(value)
+
+        def summary(self):
+            if self.length is None:
+                return '<%s at %#x>' % (self.type_name, self.id)
+            return '<%s len=%d at %#x>' % (
+                self.type_name, self.length, self.id)
+
+    class ContextLocal(object):
+        """A value that is separate for each thread and asyncio task."""
+        import threading
+        try:
+            import contextvars
+        except ImportError:  # Python 3.6 and earlier
+            contextvars = None
+
+        def __init__(self, name, default):
+            self.default = default
+            if self.contextvars:
+                self.var = self.contextvars.ContextVar(name, default=default)
+            else:
+                self.local = self.threading.local()
+
+        def get(self):
+            if self.contextvars:
+                return self.var.get()
+            return getattr(self.local, 'value', self.default)
+
+        def set(self, value):
+            if self.contextvars:
+                self.var.set(value)
+            else:
+                self.local.value = value
+
+    class Limiter(object):
+        """Decides which records from each call site get written out."""
+
+        class Site(object):
+            __slots__ = ['name', 'count', 'suppressed', 'tokens', 'last_time',
+                         'last_summary']
+
+        def __init__(self, clock):
+            self.clock = clock
+            self.every = 1  # write one in every `every` records...
+            self.first = 0  # ...after writing the first `first` records
+            self.per_second = None  # refill rate of each site's token bucket
+            self.burst = None  # capacity of each site's token bucket
+            self.summary_seconds = 10
+            self.sites = {}
+
+        def check(self, key, describe, where):
+            """Counts a record from the call site identified by key.  Returns
+            whether to write it, and the number of records suppressed since
+            the last summary, if a summary is due (otherwise 0)."""
+            now = self.clock()
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = self.Site()
+                site.name = describe(where)
+                site.count = site.suppressed = 0
+                site.tokens = self.burst
+                site.last_time = site.last_summary = now
+
+            site.count += 1
+            allow = (site.count <= self.first or
+                     (site.count - self.first - 1) % self.every == 0)
+            if allow and self.per_second is not None:
+                site.tokens = min(self.burst, site.tokens +
+                                  (now - site.last_time) * self.per_second)
+                site.last_time = now
+                if site.tokens >= 1:
+                    site.tokens -= 1
+                else:
+                    allow = False
+
+            if not allow:
+                site.suppressed += 1
+            if (site.suppressed and
+                    now - site.last_summary >= self.summary_seconds):
+                return allow, self.take_summary(site, now)
+            return allow, 0
+
+        def take_summary(self, site, now):
+            suppressed, site.suppressed = site.suppressed, 0
+            site.last_summary = now
+            return suppressed
+
+        def take_summaries(self):
+            """Gets (name, count) for every site with suppressed records."""
+            now = self.clock()
+            return [(site.name, self.take_summary(site, now))
+                    for site in list(self.sites.values()) if site.suppressed]
+
+    class TimingStats(object):
+        """Running statistics on the times taken by calls to a function.
+        Quantiles are estimated from a histogram with logarithmically sized
+        buckets, so they are accurate to within about 1%."""
+        import math
+
+        GROWTH = 1.02
+
+        def __init__(self, name):
+            self.name = name
+            self.count = 0
+            self.total = self.self_total = 0.0
+            self.min = self.max = None
+            self.buckets = {}
+
+        def add(self, seconds, own_seconds):
+            self.count += 1
+            self.total += seconds
+            self.self_total += own_seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+            bucket = int(self.math.floor(self.math.log(
+                max(seconds, 1e-9)) / self.math.log(self.GROWTH)))
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+        def quantile(self, fraction):
+            if not self.count:
+                return None
+            rank = max(1, self.math.ceil(fraction * self.count))
+            seen = 0
+            for bucket in sorted(self.buckets):
+                seen += self.buckets[bucket]
+                if seen >= rank:
+                    estimate = self.GROWTH ** (bucket + 0.5)
+                    return min(max(estimate, self.min), self.max)
+            return self.max
+
+    class SiteStats(object):
+        """Running statistics on the values passed to q.stats() at one call
+        site (or on just the number of calls, for q.count()).  The mean and
+        variance of the numbers are kept with Welford's method, and the most
+        frequent values with the space-saving algorithm: it keeps `size`
+        counters, and when a value without one comes along, it takes over
+        the smallest counter, inheriting its count as a possible error.  The
+        values are also grouped by count, so the smallest is found at once.
+        Updates hold a lock, so threads can share a call site.
+        """
+        import threading
+
+        def __init__(self, name, size=10):
+            self.lock = self.threading.Lock()
+            self.name = name
+            self.size = size
+            self.count = 0
+            self.numbers = 0  # how many of the values were numbers
+            self.mean = self.m2 = 0.0
+            self.min = self.max = None
+            self.counters = {}  # value -> [count, maximum overcount]
+            self.buckets = {}  # count -> set of the values with that count
+            self.smallest = 0  # the smallest count
+            self.last_summary = None
+
+        def hit(self):
+            with self.lock:
+                self.count += 1
+
+        def add(self, value):
+            with self.lock:
+                self.add_locked(value)
+
+        def add_locked(self, value):
+            self.count += 1
+            if isinstance(value, float) or hasattr(type(value), '__float__'):
+                try:
+                    number = float(value)
+                except (TypeError, ValueError, OverflowError):
+                    pass
+                else:
+                    self.numbers += 1
+                    delta = number - self.mean
+                    self.mean += delta / self.numbers
+                    self.m2 += delta * (number - self.mean)
+                    if self.min is None or number < self.min:
+                        self.min = number
+                    if self.max is None or number > self.max:
+                        self.max = number
+            counters, buckets = self.counters, self.buckets
+            try:
+                counter = counters.get(value)
+            except TypeError:  # unhashable
+                value = repr(value)
+                counter = counters.get(value)
+            if counter is not None:
+                count = counter[0]
+                buckets[count].remove(value)
+            elif len(counters) < self.size:
+                count = 0
+                counter = counters[value] = [0, 0]
+            else:
+                count = self.smallest
+                del counters[buckets[count].pop()]
+                counter = counters[value] = [count, count]
+            counter[0] = count + 1
+            buckets.setdefault(count + 1, set()).add(value)
+            if count and not buckets[count]:
+                del buckets[count]
+                if count == self.smallest:
+                    self.smallest = count + 1
+            elif not count:
+                self.smallest = 1
+
+        def summary(self):
+            """Gets (count, [min, mean, sd, max] or None, top values)."""
+            with self.lock:
+                numbers = None
+                if self.numbers:
+                    numbers = [self.min, self.mean, self.variance() ** 0.5,
+                               self.max]
+                return self.count, numbers, self.top()
+
+        def variance(self):
+            if self.numbers > 1:
+                return self.m2 / (self.numbers - 1)
+            return 0.0
+
+        def top(self):
+            """Gets (value, count, maximum overcount) for the most frequent
+            values, most frequent first, leaving out any that may have been
+            seen only once."""
+            return sorted([(value, count, error) for value, (count, error)
+                           in self.counters.items() if count - error > 1],
+                          key=lambda t: -t[1])
+
+    class LRUCache(object):
+        """A small least-recently-used cache that counts hits and misses."""
+        import collections
+
+        def __init__(self, maxsize=1024):
+            self.maxsize = maxsize
+            self.data = self.collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+        def get(self, key):
+            try:
+                # Popping and reinserting moves the key to the end (this also
+                # works on Python 2, which lacks OrderedDict.move_to_end).
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+        def put(self, key, value):
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+        def clear(self):
+            self.data.clear()
+            self.hits = self.misses = 0
+
     def __init__(self):
+        # When q is disabled (by setting q.enabled = False, or Q_DISABLE=1 in
+        # the environment), calls to q do nothing but return their argument.
+        self.enabled = self.os.environ.get('Q_DISABLE', '0') in ('', '0')
         self.writer = self.Writer(self.FileWriter(self.OUTPUT_PATH), self.time)
-        self.indent = 0
+        self.writer.render = self.render_record
+        # Each thread and asyncio task has its own level of indentation, so
+        # that their traced calls don't garble each other.
+        self.context_indent = self.ContextLocal('q_indent', 0)
+        # In lazy mode, reprs are rendered when records are written out.
+        self.lazy = False
+        # Optional limits on the total size of, and the time spent on, the
+        # reprs in a single record.
+        self.max_record_length = None
+        self.max_record_seconds = None
+        # Sampling and rate limits for records, if any have been set.
+        self.limiter = None
+        # Statistics for functions decorated with @q.timed, by name.
+        self.timings = {}
+        self.context_child_time = self.ContextLocal('q_child_time', None)
+        # Statistics for each call site of q.count() and q.stats(), keyed by
+        # (code object, f_lasti), which are written out every stats_seconds
+        # seconds and at exit.
+        self.site_stats = {}
+        self.stats_seconds = 10
+        # Lines of source files, for labelling output.
+        self.source_cache = self.SourceCache()
+        # Where big strings get saved, along with reprs longer than
+        # spill_length characters (which are cut short in the log).
+        self.spill_store = self.SpillStore(self.OUTPUT_PATH, self.FileWriter)
+        self.spill_length = 10000
+        # In per-process mode, each process writes to its own files.
+        self.per_process = False
+        if hasattr(self.os, 'register_at_fork'):  # Python 3.7+
+            self.os.register_at_fork(after_in_child=self.after_fork)
+        # Labels resolved for each call site, keyed by (code object, f_lasti).
+        self.label_cache = self.LRUCache()
+        # Call positions for each instruction, keyed weakly by code object.
+        self.call_positions = self.weakref.WeakKeyDictionary()
         # in_console tracks whether we're in an interactive console.
         # We use it to display the caller as "<console>" instead of "<module>".
         self.in_console = False
+        # Settings for log rotation, if it's on.
+        self.rotation = None
+        # Whether the flight recorder's hooks are in place, and the signals
+        # it's listening for.
+        self.dump_hooks = False
+        self.dump_signals = set()
+        # What trace_module and trace_class have replaced, for each module
+        # or class, as (owner, name, original, traced), so that untrace can
+        # put it back.
+        self.instrumented = {}
+        # What records calls to the functions given to q.watch(), if any.
+        self.watcher = None
+        environ = self.os.environ
+        if environ.get('Q_SINK'):
+            self.sink(environ['Q_SINK'])
+        if environ.get('Q_ROTATE_BYTES') or environ.get('Q_ROTATE_AGE'):
+            self.rotate(
+                int(environ.get('Q_ROTATE_BYTES') or 0) or None,
+                float(environ.get('Q_ROTATE_AGE') or 0) or None,
+                int(environ.get('Q_ROTATE_BACKUPS', 5)),
+                environ.get('Q_ROTATE_COMPRESS', '0') not in ('', '0'))
+
+    @property
+    def indent(self):
+        return self.context_indent.get()
+
+    @indent.setter
+    def indent(self, value):
+        self.context_indent.set(value)
+
+    def sample(self, every=1, first=0):
+        """Writes out only the first `first` records from each call site (or
+        traced function), then one in every `every` records after that."""
+        self.set_limits(every=every, first=first)
+
+    def rate_limit(self, per_second=None, burst=None):
+        """Writes out at most per_second records per second from each call
+        site (or traced function), with bursts of up to burst records.
+        Call with no arguments to remove the limit."""
+        if per_second is not None and burst is None:
+            burst = max(1, per_second)
+        self.set_limits(per_second=per_second, burst=burst)
+
+    def set_limits(self, **limits):
+        limiter = self.limiter
+        if limiter is None:
+            limiter = self.Limiter(self.clock)
+            self.atexit.register(self.summarize_suppressed)
+        for name, value in limits.items():
+            setattr(limiter, name, value)
+        if limiter.every == 1 and limiter.first == 0 and (
+                limiter.per_second is None):
+            self.summarize_suppressed()
+            limiter = None
+        self.limiter = limiter
+
+    def suppress(self, key, describe, where):
+        """Decides whether to suppress a record from the call site identified
+        by key, and periodically writes a summary of suppressed records.
+        describe(where) names the site; it is only called once per site."""
+        allow, suppressed = self.limiter.check(key, describe, where)
+        if suppressed:
+            self.write_suppressed(self.limiter.sites[key].name, suppressed)
+        return not allow
+
+    def summarize_suppressed(self):
+        """Writes out how many records were suppressed at each site."""
+        if self.limiter is not None:
+            for name, suppressed in self.limiter.take_summaries():
+                self.write_suppressed(name, suppressed)
+
+    def write_suppressed(self, name, suppressed):
+        s = self.Stanza(self.indent)
+        s.add([name + ': '])
+        s.add([self.MAGENTA, 'suppressed %d records' % suppressed,
+               self.NORMAL])
+        self.writer.write(s)
+
+    def describe_frame(self, frame):
+        return '%s:%d %s' % (
+            frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+    def describe_func(self, func):
+        return getattr(func, '__qualname__', None) or getattr(
+            func, '__name__', repr(func))
+
+    def get_output_path(self, suffix=''):
+        """Gets the path of the log (or of another output, given a suffix),
+        which is separate for each process in per-process mode."""
+        path = self.OUTPUT_PATH + suffix
+        if self.per_process:
+            path += '.%d' % self.os.getpid()
+        return path
+
+    def set_file_writer(self, file_writer):
+        """Replaces the writer for the log, keeping rotation if it's on."""
+        self.writer.file_writer.close()
+        self.writer.file_writer = self.rotating(file_writer)
+
+    def rotating(self, file_writer):
+        # Only files get rotated; a collector keeps whatever it's sent.
+        if self.rotation is None or isinstance(
+                file_writer, self.SocketWriter):
+            return file_writer
+        return self.RotatingFileWriter(file_writer, **self.rotation)
+
+    def rotate(self, max_bytes=None, max_age=None, backups=5, compress=False):
+        """Rotates the log (and the JSON Lines log, if any) once it has grown
+        past max_bytes or is older than max_age seconds, keeping backups old
+        logs as /tmp/q.1, /tmp/q.2 and so on, gzipped if compress is true.
+        Call with no arguments to stop rotating.  The Q_ROTATE_BYTES,
+        Q_ROTATE_AGE, Q_ROTATE_BACKUPS and Q_ROTATE_COMPRESS environment
+        variables set these at startup."""
+        writers = [self.writer.file_writer, self.writer.record_writer]
+        writers = [getattr(w, 'file_writer', w) for w in writers]
+        self.rotation = None
+        if max_bytes is not None or max_age is not None:
+            self.rotation = dict(max_bytes=max_bytes, max_age=max_age,
+                                 backups=backups, compress=compress)
+        if not isinstance(writers[0], self.SocketWriter):
+            self.set_file_writer(writers[0])
+        if writers[1]:
+            self.writer.record_writer = self.rotating(writers[1])
+
+    def sink(self, address=None):
+        """Streams the log to a collector (started with "python -m q --collect
+        <address>") instead of writing it to a file, for when /tmp is
+        read-only or thrown away, or to merge the logs of many processes.
+        The address is 'unix:<path>' (or just a path) for a Unix domain
+        socket, or '<host>:<port>' (or just a port, on localhost) for TCP.
+        Call with no address to go back to the log file.  The Q_SINK
+        environment variable sets this at startup."""
+        self.writer.file_writer.close()
+        if address:
+            self.writer.file_writer = self.SocketWriter(
+                *self.parse_address(address))
+        else:
+            self.writer.file_writer = self.rotating(
+                self.FileWriter(self.get_output_path()))
+
+    def collect(self, address, path=None):
+        """Appends everything that processes stream to address with q.sink()
+        to path (by default, the log path), until interrupted."""
+        collector = self.Collector(
+            *self.parse_address(address), path=path or self.OUTPUT_PATH)
+        try:
+            collector.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            collector.close()
+
+    def parse_address(self, address):
+        """Gets (family, address) for a socket address given to q.sink() or
+        q.collect()."""
+        address = str(address)
+        if address.startswith('unix:') or '/' in address:
+            return self.socket.AF_UNIX, address.split('unix:', 1)[-1]
+        host, _, port = address.rpartition(':')
+        return self.socket.AF_INET, (host or '127.0.0.1', int(port))
+
+    def buffered(self, max_size=65536, max_delay=0.5):
+        """Keeps the log file open and buffers output to it.  Output is
+        written once max_size bytes are pending, max_delay seconds after it
+        was buffered, or when the program exits."""
+        self.set_file_writer(self.BufferedFileWriter(
+            self.get_output_path(), max_size, max_delay))
+
+    def unbuffered(self):
+        """Writes output to the log immediately (the default)."""
+        self.set_file_writer(self.FileWriter(self.get_output_path()))
+
+    def multiprocess(self, enabled=True, per_process=False):
+        """Makes the log safe to share between processes, such as the workers
+        of a forking server: each record goes out in one atomic append (or
+        under a file lock, if it's big), every record is tagged with its
+        process ID, and timestamps are taken from the clock (modulo 100s)
+        rather than from when each process started, so they agree.
+
+        With per_process, each process writes its own log, /tmp/q.<pid>,
+        and its records as JSON to /tmp/q.jsonl.<pid>; to see them all in
+        order, run "python -m q /tmp/q.jsonl.*"."""
+        if self.per_process:
+            self.json_lines(False)
+        self.per_process = enabled and per_process
+        self.writer.show_pid = enabled
+        self.writer.start_time = enabled and 0 or self.time.time()
+        if enabled:
+            self.set_file_writer(self.BufferedFileWriter(
+                self.get_output_path(), max_size=0))
+        else:
+            self.set_file_writer(self.FileWriter(self.get_output_path()))
+        if self.per_process:
+            self.json_lines(path=self.get_output_path('.jsonl'))
+
+    def after_fork(self):
+        """Resets per-process state in a child process after a fork."""
+        self.writer.after_fork()
+        if self.per_process:
+            self.writer.file_writer.path = self.get_output_path()
+            if self.writer.record_writer:
+                self.writer.record_writer.path = self.get_output_path(
+                    '.jsonl')
+
+    def background(self, max_queue=10000):
+        """Formats and writes output on a separate thread, so that slow disks
+        don't hold up the program.  Queued output is written out at exit."""
+        self.writer.start_thread(max_queue)
+
+    def foreground(self):
+        """Formats and writes output in the calling thread (the default)."""
+        self.writer.stop_thread()
+
+    def flight_recorder(self, enabled=True, size=10000, signum='SIGUSR1'):
+        """Keeps the last size records in memory instead of writing them
+        out, and writes them out when q.dump() is called, when an exception
+        goes unhandled, when the process gets the signal named by signum
+        (only if this is called on the main thread), or at exit.  Call with
+        enabled=False to write out what's kept and go back to writing
+        records out as they come."""
+        if not enabled:
+            self.writer.stop_recording()
+            return
+        self.writer.start_recording(size)
+        if not self.dump_hooks:
+            self.dump_hooks = True
+            self.install_dump_hooks()
+        signum = getattr(self.signal, signum or '', None)  # not on Windows
+        if signum is not None and signum not in self.dump_signals:
+            previous = self.signal.getsignal(signum)
+
+            def handler(signum, frame):
+                self.dump()
+                if callable(previous):
+                    previous(signum, frame)
+
+            try:
+                self.signal.signal(signum, handler)
+                self.dump_signals.add(signum)
+            except ValueError:  # not on the main thread
+                pass
+
+    def install_dump_hooks(self):
+        """Dumps the flight recorder at exit and on unhandled exceptions,
+        before calling the hooks that were there before."""
+        self.atexit.register(self.dump)
+        for module in [self.sys, self.threading]:
+            previous = getattr(module, 'excepthook', None)  # Python 3.8+
+            if previous is not None:
+                module.excepthook = self.chain_dump(previous)
+
+    def chain_dump(self, previous):
+        def excepthook(*args):
+            self.dump()
+            previous(*args)
+        return excepthook
+
+    def dump(self):
+        """Writes out the records that the flight recorder has kept."""
+        self.writer.dump()
+
+    def json_lines(self, enabled=True, path=None, text=True):
+        """Writes each record as a line of JSON to path (by default, the log
+        path plus '.jsonl'), along with the text log or, if text is false,
+        instead of it.  Call with enabled=False to stop.  You can filter and
+        print out the records with "python -m q <path>"."""
+        if self.writer.record_writer:
+            self.writer.record_writer.close()
+        self.writer.record_writer = enabled and self.rotating(self.FileWriter(
+            path or self.get_output_path('.jsonl'))) or None
+        self.writer.text = text or not enabled
+
+    def read_records(self, paths):
+        """Reads records written by json_lines() from the given files, merged
+        into a single sequence in time order."""
+        import heapq
+        import json
+
+        def read(i, path):
+            with open(path) as file:
+                for n, line in enumerate(file):
+                    if line.strip():
+                        record = json.loads(line)
+                        yield record.get('time', 0), i, n, record
+
+        for _, _, _, record in heapq.merge(
+                *[read(i, path) for i, path in enumerate(paths)]):
+            yield record
+
+    def main(self, argv):
+        """Prints out records written by json_lines() in the format of the
+        text log, optionally filtered by kind, function, file or pid; or,
+        with --collect, collects the output that q.sink() streams."""
+        import argparse
+        import json
+
+        parser = argparse.ArgumentParser(
+            prog='python -m q', description=self.main.__doc__)
+        parser.add_argument('paths', nargs='*', metavar='path',
+                            help='JSON Lines files written by q.json_lines()')
+        parser.add_argument('--kind', action='append', help=(
+            'show only records of this kind (value, call, return, '
+            'exception, yield, resume, note)'))
+        parser.add_argument('--function', help=(
+            'show only records whose function name contains this'))
+        parser.add_argument('--file', help=(
+            'show only records whose filename contains this'))
+        parser.add_argument('--pid', type=int, action='append',
+                            help='show only records from this process')
+        parser.add_argument('--no-color', dest='color', action='store_false',
+                            help='leave out ANSI color codes')
+        parser.add_argument('--json', action='store_true', help=(
+            'print the matching records as JSON Lines'))
+        parser.add_argument('--collect', metavar='address', help=(
+            'instead, collect the output that processes send to this address '
+            'with q.sink(), and append it to the log (or to --output)'))
+        parser.add_argument('--output', metavar='path', help=(
+            'where to append collected output'))
+        args = parser.parse_args(argv)
+        if args.collect:
+            return self.collect(args.collect, args.output)
+        if not args.paths:
+            parser.error('give the paths of some JSON Lines files')
+
+        writer = self.Writer(self.StreamWriter(self.sys.stdout), self.time)
+        writer.render = self.render_record
+        writer.color = args.color
+        writer.start_time = None
+        for record in self.read_records(args.paths):
+            if ((args.kind and record.get('kind') not in args.kind) or
+                    (args.function and args.function not in (
+                        record.get('function') or '')) or
+                    (args.file and args.file not in (
+                        record.get('file') or '')) or
+                    (args.pid and record.get('pid') not in args.pid)):
+                continue
+            if args.json:
+                self.sys.stdout.write(json.dumps(record, sort_keys=True))
+                self.sys.stdout.write('\n')
+                continue
+            if writer.start_time is None:
+                writer.start_time = record['time']
+            writer.write_items([
+                (record['time'], record.get('tag'), None, record)])
+        writer.file_writer.flush()
 
     def unindent(self, lines):
         """Removes any indentation that is common to all of the given lines."""
@@ -221,27 +2262,58 @@ class Q(object):
             len(self.re.match(r'^ *', line).group()) for line in lines)
         return [line[indent:].rstrip() for line in lines]
 
-    def safe_repr(self, value):
+    def get_repr(self):
+        """Gets the Repr for the current short or long setting."""
+        cls = self.__class__
+        if cls.REPR is None:
+            limits = not cls.q_long and cls.SHORT_REPR_LIMITS or {}
+            cls.REPR = cls.Repr(cls.q_max_length, **limits)
+        return cls.REPR
+
+    def safe_repr(self, value, max_length=None):
+        """Gets the repr of a value, stopping after max_length characters
+        (or q_max_length, if that's smaller)."""
         # TODO: Use colour to distinguish '...' elision from actual '...'
         # TODO: Show a nicer repr for SRE.Match objects.
         # TODO: Show a nicer repr for big multiline strings.
-        result = self.TEXT_REPR.repr(value)
+        repr_ = self.REPR or self.get_repr()
+        spill_length = self.spill_length
+        if spill_length is None or (
+                max_length is not None and max_length <= spill_length):
+            spill_length = None
+        result = repr_.repr(value, spill_length or max_length)
         if isinstance(value, self.BASESTRING_TYPES) and len(value) > 80:
             # If the string is big, save it to a file for later examination.
             if isinstance(value, self.TEXT_TYPES):
                 value = value.encode('utf-8')
-            path = self.OUTPUT_PATH + (
-                    '%08d.txt' % self.random.randrange(100000000))
-            self.FileWriter(path).write('w', value)
-            result += ' (file://' + path + ')'
+            result += ' (' + self.spill_store.store(value) + ')'
+        elif spill_length and len(result) > spill_length:
+            # The repr was cut short, so stream all of it to a file, and
+            # keep just the beginning for the log.
+            url = self.spill_store.store_stream(lambda write: repr_.stream(
+                value, write, self.spill_store.max_bytes))
+            if url:
+                result += ' (' + url + ')'
         return result
 
-    class CallVisitor(ast.NodeVisitor):
-        def __init__(self, call_position):
+    class CallVisitor(object):
+        """Finds the call at a given position, in the order in which calls
+        are made, in a syntax tree.  This works like an ast.NodeVisitor, but
+        doesn't need ast imported until it's used."""
+
+        def __init__(self, ast, call_position):
+            self.ast = ast
             self.current_position = 0
             self.call_position = call_position
             self.call_node = None
 
+        def visit(self, node):
+            if isinstance(node, self.ast.Call):
+                self.visit_Call(node)
+            else:
+                for child in self.ast.iter_child_nodes(node):
+                    self.visit(child)
+
         def visit_Call(self, node):
             # Arguments have a lower call position then the function call
             # For instance, in q(q(1) + q(2)),
@@ -296,6 +2368,46 @@ class Q(object):
                     args.append(line[offsets[i]:offsets[i + 1]].rstrip(', '))
                 return args
 
+    def get_call_positions(self, code):
+        """Maps each bytecode offset in a code object to the number of calls
+        that precede it on its source line (its "position of call on line").
+
+        The map is built once per code object, so finding the position of
+        the current call is a dictionary lookup instead of a scan."""
+        try:
+            return self.call_positions[code]
+        except (KeyError, TypeError):
+            pass
+
+        positions = {}
+        position = 0
+        previous = None
+        for instruction in self.dis.get_instructions(code):
+            # starts_line is a line number (or None) before Python 3.13, and
+            # a bool from 3.13 onwards.
+            starts_line = instruction.starts_line
+            if starts_line is not None and starts_line is not False:
+                position = 0
+            # It seems sometimes CACHE instructions cause f_lasti to be after
+            # the call instruction offset, so the offsets between two
+            # instructions map to the position of the earlier one.
+            if previous is not None:
+                for offset in range(previous + 1, instruction.offset):
+                    positions[offset] = positions[previous]
+            positions[instruction.offset] = position
+            previous = instruction.offset
+            if (instruction.opname.startswith('CALL') and
+                    not instruction.opname.startswith('CALL_INTRINSIC')):
+                position += 1
+        # Offsets past the last instruction belong to the last instruction.
+        positions[None] = positions.get(previous, 0)
+
+        try:
+            self.call_positions[code] = positions
+        except TypeError:  # code objects aren't weakly referenceable here
+            pass
+        return positions
+
     def _get_accurate_call_exprs(self, caller_frame, line, tree):
         """Gets the argument expressions from the source of a function call.
 
@@ -306,38 +2418,18 @@ class Q(object):
         # correct output, we need to identify what function call we
         # are getting the call expressions for. To do this, we can
         # use frame data to get the caller's bytecode and the
-        # bytecode instruction being executed. We can then
-        # count the number of CALL_* opcodes before the condition
-        # `instruction.starts_line is not None` is met.
-        caller_bytecode = caller_frame.f_code
-        call_bytecode_instruction_offset = caller_frame.f_lasti
-        bytecode_instructions = \
-            tuple(self.dis.get_instructions(caller_bytecode))
-        call_bytecode_instruction_index = 0
-        for instruction in bytecode_instructions:
-            if instruction.offset == call_bytecode_instruction_offset:
-                break
-            elif instruction.offset > call_bytecode_instruction_offset:
-                # It seems sometimes CACHE instructions cause
-                # caller_frame.f_lasti to be after the call instruction offset
-                call_bytecode_instruction_index -= 1
-                break
-            call_bytecode_instruction_index += 1
-
-        current_bytecode_instruction = \
-            bytecode_instructions[call_bytecode_instruction_index]
-        position_of_call_on_line = 0
-        instruction_index = call_bytecode_instruction_index
-        while current_bytecode_instruction.starts_line is None:
-            instruction_index = instruction_index - 1
-            current_bytecode_instruction = \
-                bytecode_instructions[instruction_index]
-            if current_bytecode_instruction.opname.startswith('CALL'):
-                position_of_call_on_line += 1
-
-        call_visitor = self.CallVisitor(position_of_call_on_line)
+        # bytecode instruction being executed, and look up how many
+        # CALL_* opcodes precede it on its line.
+        positions = self.get_call_positions(caller_frame.f_code)
+        position_of_call_on_line = positions.get(
+            caller_frame.f_lasti, positions[None])
+
+        call_visitor = self.CallVisitor(
+            self.ast, position_of_call_on_line)
         call_visitor.visit(tree)
         node = call_visitor.call_node
+        if node is None:
+            return None
 
         offsets = []
         for arg in node.args:
@@ -353,112 +2445,913 @@ class Q(object):
             args.append(line[offsets[i]:offsets[i + 1]].rstrip(', '))
         return args
 
-    def show(self, func_name, values, labels=None):
-        """Prints out nice representations of the given values."""
-        s = self.Stanza(self.indent)
+    def snapshot(self, values):
+        """In lazy mode, wraps values so that their reprs are put off until
+        the record is written out; otherwise returns them unchanged."""
+        if not self.lazy:
+            return values
+        return [self.LazyRepr(value) for value in values]
+
+    def render_reprs(self, values):
+        """Gets the reprs of a record's values, truncating them once the
+        budget of max_record_length characters or max_record_seconds for
+        the record has run out."""
+        length_left = self.max_record_length
+        deadline = self.max_record_seconds
+        if deadline is not None:
+            deadline += self.clock()
+        reprs = []
+        for value in values:
+            lazy = None
+            if isinstance(value, self.LazyRepr):
+                lazy, value = value, value.value
+            if ((length_left is not None and length_left <= 0) or
+                    (deadline is not None and self.clock() > deadline)):
+                lazy = lazy or self.LazyRepr(value)
+                reprs.append(lazy.summary() + self.TRUNCATED)
+                continue
+            result = self.safe_repr(value, length_left)
+            if length_left is not None:
+                if len(result) > length_left:
+                    result = result[:length_left] + self.TRUNCATED
+                length_left -= len(result)
+            reprs.append(result)
+        return reprs
+
+    def emit(self, build, *args):
+        """Writes out the record that build(*args) returns.  In lazy mode
+        building the record (and so computing the reprs in it) is deferred
+        until the writer writes it out, which happens on the writer's thread
+        when writing in the background."""
+        if self.lazy:
+            self.writer.write(lambda: build(*args))
+        else:
+            self.writer.write(build(*args))
+
+    def show(self, func_name, values, labels=None, where=None):
+        """Prints out nice representations of the given values.  where is
+        the (filename, line number) of the call, if known."""
         if func_name == '<module>' and self.in_console:
             func_name = '<console>'
-        s.add([func_name + ': '])
-        reprs = map(self.safe_repr, values)
-        if labels:
+        self.emit(self.build_values, self.indent, func_name, where,
+                  self.snapshot(values), labels)
+
+    def build_values(self, indent, func_name, where, values, labels):
+        return {'kind': 'value', 'indent': indent, 'function': func_name,
+                'file': where and where[0], 'line': where and where[1],
+                'labels': labels, 'reprs': self.render_reprs(values)}
+
+    def build_call(self, indent, func_name, where, args, names, values):
+        return {'kind': 'call', 'indent': indent, 'function': func_name,
+                'file': where[0], 'line': where[1],
+                'labels': [None] * len(args) + names,
+                'reprs': self.render_reprs(list(args) + list(values))}
+
+    def build_return(self, indent, func_name, where, result, timing=''):
+        return {'kind': 'return', 'indent': indent, 'function': func_name,
+                'file': where[0], 'line': where[1], 'timing': timing,
+                'reprs': self.render_reprs([result])}
+
+    def build_yield(self, indent, func_name, where, value):
+        return {'kind': 'yield', 'indent': indent, 'function': func_name,
+                'file': where[0], 'line': where[1],
+                'reprs': self.render_reprs([value])}
+
+    def build_resume(self, indent, func_name, where, value, thrown):
+        return {'kind': 'resume', 'indent': indent, 'function': func_name,
+                'file': where[0], 'line': where[1], 'thrown': thrown,
+                'reprs': self.render_reprs([value])}
+
+    def build_exception(self, indent, func_name, evalue, tb, timing=''):
+        filename = tb.tb_frame.f_code.co_filename
+        code_context, index = self.get_context(
+            filename, tb.tb_lineno, 3, tb)
+        record = {'kind': 'exception', 'indent': indent,
+                  'function': func_name, 'file': filename,
+                  'line': tb.tb_lineno, 'timing': timing,
+                  'reprs': self.render_reprs([evalue])}
+        if code_context:
+            record['context'] = {'lines': self.unindent(code_context),
+                                 'index': index}
+        return record
+
+    def render_record(self, record):
+        """Lays out a record as a Stanza for the text log.  A record
+        is a dict that can be serialized as JSON; its 'kind' is 'value' (from
+        q(), q/ or q|), 'call', 'return' or 'exception' (from tracing),
+        'yield' or 'resume' (from tracing generators), or 'note' (anything
+        else, with the plain 'text' of the note)."""
+        kind = record.get('kind')
+        reprs = record.get('reprs') or []
+        labels = record.get('labels') or [None] * len(reprs)
+        s = self.Stanza(record.get('indent', 0))
+        if kind == 'value':
+            s.add([record['function'] + ': '])
             sep = ''
             for label, repr in zip(labels, reprs):
-                s.add([label + '=', self.CYAN, repr, self.NORMAL], sep)
+                s.add((label and [label + '='] or []) +
+                      [self.CYAN, repr, self.NORMAL], sep)
                 sep = ', '
-        else:
+        elif kind == 'call':
+            s.add([self.GREEN, record['function'], self.NORMAL, '('])
+            s.indent += 4
             sep = ''
-            for repr in reprs:
-                s.add([self.CYAN, repr, self.NORMAL], sep)
+            for label, repr in zip(labels, reprs):
+                s.add((label and [label + '='] or []) +
+                      [self.CYAN, repr, self.NORMAL], sep)
                 sep = ', '
-        self.writer.write(s.chunks)
+            s.add(')', wrap=False)
+        elif kind == 'return':
+            s.add([self.GREEN, '-> ', self.CYAN, reprs[0], self.NORMAL])
+            if record.get('timing'):
+                s.add([self.YELLOW, record['timing'], self.NORMAL], ' ')
+        elif kind == 'yield':
+            s.add([self.GREEN, 'yield ', self.CYAN, reprs[0], self.NORMAL])
+        elif kind == 'resume':
+            if record.get('thrown'):
+                s.add([self.RED, '<! ', reprs[0], self.NORMAL])
+            else:
+                s.add([self.GREEN, '<- ', self.CYAN, reprs[0], self.NORMAL])
+        elif kind == 'exception':
+            s.add([self.RED, '!> ', reprs[0], self.NORMAL])
+            if record.get('timing'):
+                s.add([self.YELLOW, record['timing'], self.NORMAL], ' ')
+            s.add(['at ', record['file'], ':', record['line']], ' ')
+            context = record.get('context')
+            if context:
+                lines, index = context['lines'], context['index']
+                firstlineno = record['line'] - index
+                fmt = '%' + str(len(str(firstlineno + len(lines)))) + 'd'
+                for i, line in enumerate(lines):
+                    s.newline()
+                    s.add([
+                        i == index and self.MAGENTA or '',
+                        fmt % (i + firstlineno),
+                        i == index and '> ' or ': ', line, self.NORMAL])
+        else:
+            s.add([record.get('text', '')])
+        return s
+
+    class Watcher(object):
+        """Records calls to, and returns from, a chosen set of functions
+        without wrapping them, in a compact buffer that is written out as
+        q's usual records every max_events events, when the last function
+        is unwatched, and at exit.  On Python 3.12+, sys.monitoring raises
+        events for just those functions, so other code runs at full speed;
+        before that, a sys.settrace hook checks every call (in the calling
+        thread and threads started after watching begins), and sees each
+        resumption of a generator as a call.  As there can only be one such
+        hook, q.watch refuses to start while a debugger or coverage tool has
+        set its own."""
+        import atexit
+        import collections
+        import sys
+        import threading
+
+        CO_VARARGS = 0x04
+        CO_VARKEYWORDS = 0x08
+
+        def __init__(self, q, max_events=1000):
+            self.q = q
+            self.max_events = max_events
+            self.codes = {}  # code object -> names of its arguments
+            self.names = {}  # the same, kept after unwatching for flush()
+            self.events = self.collections.deque()
+            self.local = self.threading.local()  # depth of watched calls
+            self.monitoring = getattr(self.sys, 'monitoring', None)
+            self.tool = None
+            self.thread_hook = None  # what threading.settrace had before
+            self.atexit.register(self.flush)
+
+        def add(self, code):
+            if code in self.codes:
+                return
+            if not self.codes and not self.monitoring and self.sys.gettrace():
+                raise RuntimeError('a trace function is already set')
+            count = code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)
+            count += bool(code.co_flags & self.CO_VARARGS)
+            count += bool(code.co_flags & self.CO_VARKEYWORDS)
+            self.codes[code] = self.names[code] = list(
+                code.co_varnames[:count])
+            if self.monitoring:
+                events = self.monitoring.events
+                if self.tool is None:
+                    self.start_monitoring()
+                self.monitoring.set_local_events(
+                    self.tool, code, events.PY_START | events.PY_RETURN |
+                    events.PY_YIELD | events.PY_RESUME)
+            elif len(self.codes) == 1:
+                self.thread_hook = getattr(self.threading, '_trace_hook', None)
+                self.sys.settrace(self.trace)
+                self.threading.settrace(self.trace)
+
+        def remove(self, code):
+            if self.codes.pop(code, None) is None:
+                return
+            if self.monitoring:
+                self.monitoring.set_local_events(self.tool, code, 0)
+                if not self.codes:
+                    self.stop_monitoring()
+            elif not self.codes:
+                self.sys.settrace(None)
+                self.threading.settrace(self.thread_hook)
+                self.thread_hook = None
+            if not self.codes:
+                self.flush()
+
+        def start_monitoring(self):
+            monitoring = self.monitoring
+            events = monitoring.events
+            for tool in [monitoring.PROFILER_ID] + list(range(6)):
+                if monitoring.get_tool(tool) is None:
+                    break
+            else:
+                raise RuntimeError('all sys.monitoring tool IDs are in use')
+            monitoring.use_tool_id(tool, 'q')
+            self.tool = tool
+            for event, callback in [
+                    (events.PY_START, self.on_start),
+                    (events.PY_RESUME, self.on_resume),
+                    (events.PY_RETURN, self.on_return),
+                    (events.PY_YIELD, self.on_yield),
+                    (events.PY_UNWIND, self.on_unwind)]:
+                monitoring.register_callback(tool, event, callback)
+            # Unwinding can only be watched for all code at once.
+            monitoring.set_events(tool, events.PY_UNWIND)
+
+        def stop_monitoring(self):
+            self.monitoring.set_events(self.tool, 0)
+            self.monitoring.free_tool_id(self.tool)
+            self.tool = None
+
+        def record(self, kind, code, value, depth_change):
+            depth = getattr(self.local, 'depth', 0)
+            if depth_change < 0:
+                depth += depth_change
+            self.local.depth = depth + (depth_change > 0)
+            self.events.append((
+                kind, code, value, self.q.time.time(), self.q.writer.get_tag(),
+                self.q.indent + 2 * max(depth, 0)))
+            if len(self.events) >= self.max_events:
+                self.flush()
+
+        # sys.monitoring callbacks, which are called from the watched frame.
+        def on_start(self, code, offset):
+            frame = self.sys._getframe(1)
+            self.record('call', code, [
+                frame.f_locals.get(name) for name in self.codes[code]], 1)
+
+        def on_resume(self, code, offset):
+            self.local.depth = getattr(self.local, 'depth', 0) + 1
+
+        def on_return(self, code, offset, value):
+            self.record('return', code, value, -1)
+
+        def on_yield(self, code, offset, value):
+            self.record('yield', code, value, -1)
+
+        def on_unwind(self, code, offset, exception):
+            if code in self.codes:
+                self.record('exception', code, (
+                    exception, self.sys._getframe(1).f_lineno), -1)
+
+        def trace(self, frame, event, arg):
+            """The sys.settrace hook, for Python 3.11 and earlier."""
+            code = frame.f_code
+            if code not in self.codes:
+                return None
+            self.record('call', code, [
+                frame.f_locals.get(name) for name in self.codes[code]], 1)
+            if hasattr(frame, 'f_trace_lines'):  # Python 3.7+
+                frame.f_trace_lines = False
+            return self.trace_frame
+
+        def trace_frame(self, frame, event, arg):
+            """Traces a watched frame to its return, yield or exception."""
+            if event == 'exception':
+                self.local.exception = arg[1]
+            elif event == 'return':
+                if arg is None and self.unwinding(frame):
+                    self.record('exception', frame.f_code, (
+                        self.local.exception, frame.f_lineno), -1)
+                else:
+                    self.record('return', frame.f_code, arg, -1)
+            return self.trace_frame
+
+        def unwinding(self, frame):
+            """Tells whether a frame that is returning None is doing so
+            because of an exception: returns and yields stop on their own
+            instructions, or just before a YIELD_FROM that is waiting."""
+            opmap = self.q.dis.opmap
+            ops = bytearray(frame.f_code.co_code[
+                frame.f_lasti:frame.f_lasti + 3])
+            return not (
+                ops[0] in (opmap['RETURN_VALUE'], opmap['YIELD_VALUE']) or
+                len(ops) == 3 and ops[2] == opmap.get('YIELD_FROM'))
+
+        def flush(self):
+            """Writes out the recorded events as records."""
+            q = self.q
+            events = self.events
+            for i in range(len(events)):  # not events that reprs cause
+                kind, code, value, now, tag, indent = events.popleft()
+                name = getattr(code, 'co_qualname', code.co_name)
+                where = (code.co_filename, code.co_firstlineno)
+                if kind == 'call':
+                    record = q.build_call(
+                        indent, name, where, (), self.names[code], value)
+                elif kind == 'return':
+                    record = q.build_return(indent, name, where, value)
+                elif kind == 'yield':
+                    record = q.build_yield(indent + 2, name, where, value)
+                else:
+                    exception, line = value
+                    record = {'kind': 'exception', 'indent': indent,
+                              'function': name, 'file': where[0],
+                              'line': line, 'timing': '',
+                              'reprs': q.render_reprs([exception])}
+                q.writer.write(record, now, tag)
+
+    class TracedBody(object):
+        """Traces the body of a generator or coroutine as it runs, a step
+        at a time, from wherever it's resumed: the body runs at the traced
+        call's indentation, its return or exception is shown when it ends,
+        and, if it's timed, the time it spends running (but not suspended)
+        is counted."""
+        STOP = StopIteration  # raised when the body returns
+        PASS = ()  # exceptions that are not the body's to report
+
+        def __init__(self, q, inner, func_name, where, indent, stats):
+            self.q = q
+            self.inner = inner
+            self.func_name = func_name
+            self.where = where
+            self.indent = indent  # the indentation of the body
+            self.stats = stats  # timing statistics, if it's timed
+            self.times = [0.0, 0.0, 0.0]  # wall, cpu and self seconds
+
+        def __getattr__(self, name):  # e.g. gi_frame, cr_await
+            return getattr(self.inner, name)
+
+        def step(self, method, *args):
+            """Runs the body until it next yields, returns or raises."""
+            q = self.q
+            outer = q.indent
+            q.indent = self.indent
+            timer = self.stats and q.start_timer()
+            try:
+                try:
+                    return method(*args)
+                finally:
+                    q.indent = outer
+                    if timer:
+                        for i, t in enumerate(q.read_timer(timer)):
+                            self.times[i] += t
+            except self.PASS:
+                raise
+            except self.STOP as e:
+                q.emit(q.build_return, self.indent - 2, self.func_name,
+                       self.where, q.snapshot([getattr(e, 'value', None)])[0],
+                       self.finish())
+                raise
+            except Exception:
+                etype, evalue, etb = q.sys.exc_info()
+                q.writer.write(q.build_exception(
+                    self.indent - 2, self.func_name, evalue,
+                    etb.tb_next or etb, self.finish()))
+                raise
+
+        def finish(self):
+            """Adds the run time to the statistics and formats it."""
+            if self.stats:
+                self.stats.add(self.times[0], self.times[2])
+                return self.q.format_timing(*self.times)
+            return ''
+
+        def show(self, build, *args):
+            q = self.q
+            if q.limiter is None or not q.suppress(
+                    (self.where, build), q.describe_func, self.inner):
+                q.emit(build, self.indent, self.func_name, self.where, *args)
+
+        def resumed(self, value, thrown=False):
+            self.show(self.q.build_resume, self.q.snapshot([value])[0], thrown)
+
+        def yielded(self, value):
+            self.show(self.q.build_yield, self.q.snapshot([value])[0])
+            return value
+
+    class TracedGenerator(TracedBody):
+        """Traces a generator: each item it yields, each value or exception
+        sent into it, and how it ends."""
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return self.yielded(self.step(self.inner.send, None))
+
+        next = __next__  # Python 2
+
+        def send(self, value):
+            if value is not None:
+                self.resumed(value)
+            return self.yielded(self.step(self.inner.send, value))
+
+        def throw(self, *args):
+            value = args[1] if len(args) > 1 else None  # not a traceback
+            self.resumed(args[0] if value is None else value, True)
+            return self.yielded(self.step(self.inner.throw, *args))
 
-    def trace(self, func):
-        """Decorator to print out a function's arguments and return value."""
+        def close(self):
+            self.inner.close()
 
-        def get_func_name(func):
-            return getattr(func, "__qualname__", func.__name__)
+    class TracedCoroutine(TracedBody):
+        """Traces a coroutine: its result or exception, after however many
+        awaits.  Whatever it awaits passes straight through."""
+
+        def __await__(self):
+            return self
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return self.step(self.inner.send, None)
+
+        def send(self, value):
+            return self.step(self.inner.send, value)
+
+        def throw(self, *args):
+            return self.step(self.inner.throw, *args)
+
+        def close(self):
+            self.inner.close()
+
+    class TracedAsyncGenerator(TracedBody):
+        """Traces an async generator: each item it yields, each value or
+        exception sent into it, and how it ends."""
+        try:
+            STOP = StopAsyncIteration
+        except NameError:  # Python 2, which has no async generators
+            STOP = None
+        PASS = StopIteration  # how each awaited step delivers its item
+
+        class Step(object):
+            """Awaits one step of an async generator."""
+
+            def __init__(self, traced, awaitable):
+                self.traced = traced
+                self.iterator = awaitable.__await__()
+
+            def __await__(self):
+                return self
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                return self.send(None)
+
+            def send(self, value):
+                return self.run(self.iterator.send, value)
+
+            def throw(self, *args):
+                return self.run(self.iterator.throw, *args)
+
+            def run(self, method, *args):
+                try:
+                    return self.traced.step(method, *args)
+                except StopIteration as e:
+                    self.traced.yielded(e.value)
+                    raise
+
+        def __aiter__(self):
+            return self
+
+        def __anext__(self):
+            return self.Step(self, self.inner.__anext__())
+
+        def asend(self, value):
+            if value is not None:
+                self.resumed(value)
+            return self.Step(self, self.inner.asend(value))
+
+        def athrow(self, *args):
+            value = args[1] if len(args) > 1 else None  # not a traceback
+            self.resumed(args[0] if value is None else value, True)
+            return self.Step(self, self.inner.athrow(*args))
+
+        def aclose(self):
+            return self.inner.aclose()
+
+    # Flags on the code objects of generator, coroutine and async generator
+    # functions, and the classes that trace the objects that they return.
+    CO_GENERATOR = 0x20
+    CO_COROUTINE = 0x80
+    CO_ASYNC_GENERATOR = 0x200
+
+    def get_body_tracer(self, code):
+        """Gets the class that traces the generator or coroutine returned by
+        a function with the given code, if it returns one."""
+        flags = getattr(code, 'co_flags', 0)
+        if flags & self.CO_GENERATOR:
+            return self.TracedGenerator
+        if flags & self.CO_COROUTINE:
+            return self.TracedCoroutine
+        if flags & self.CO_ASYNC_GENERATOR:
+            return self.TracedAsyncGenerator
+
+    def trace(self, func, timed=False):
+        """Decorator to print out a function's arguments and return value.
+        If timed is true, also shows and collects statistics on how long
+        each call took.  Generators, coroutines and async generators are
+        traced as they run: their items, how they end, and (if timed) the
+        time spent running them.  If q is disabled, returns func as it is."""
+        if not self.enabled:
+            return func
+        func_name = self.describe_func(func)
+        code = getattr(func, '__code__', None)
+        where = code and (code.co_filename, code.co_firstlineno) or (
+            None, None)
+        stats = timed and self.get_timing_stats(func_name) or None
+        body_tracer = self.get_body_tracer(code)
+        if body_tracer:
+            timed = False  # the body tracer times the body instead
 
         def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            if self.limiter is not None and self.suppress(
+                    wrapper, self.describe_func, func):
+                if not timed:
+                    return func(*args, **kwargs)
+                timer = self.start_timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.stop_timer(timer, stats)
+
             # Print out the call to the function with its arguments.
-            s = self.Stanza(self.indent)
-            s.add([self.GREEN, get_func_name(func), self.NORMAL, '('])
-            s.indent += 4
-            sep = ''
-            for arg in args:
-                s.add([self.CYAN, self.safe_repr(arg), self.NORMAL], sep)
-                sep = ', '
-            for name, value in sorted(kwargs.items()):
-                s.add([name + '=', self.CYAN, self.safe_repr(value),
-                       self.NORMAL], sep)
-                sep = ', '
-            s.add(')', wrap=False)
-            self.writer.write(s.chunks)
+            names = sorted(kwargs)
+            self.emit(self.build_call, self.indent, func_name, where,
+                      self.snapshot(args),
+                      names, self.snapshot([kwargs[name] for name in names]))
 
             # Call the function.
             self.indent += 2
+            timing = ''
+            if timed:
+                timer = self.start_timer()
             try:
                 result = func(*args, **kwargs)
             except Exception:
                 # Display an exception.
                 self.indent -= 2
+                if timed:
+                    timing = self.stop_timer(timer, stats)
                 etype, evalue, etb = self.sys.exc_info()
-                info = self.inspect.getframeinfo(etb.tb_next, context=3)
-                s = self.Stanza(self.indent)
-                s.add([self.RED, '!> ', self.safe_repr(evalue), self.NORMAL])
-                s.add(['at ', info.filename, ':', info.lineno], ' ')
-                lines = self.unindent(info.code_context)
-                firstlineno = info.lineno - info.index
-                fmt = '%' + str(len(str(firstlineno + len(lines)))) + 'd'
-                for i, line in enumerate(lines):
-                    s.newline()
-                    s.add([
-                        i == info.index and self.MAGENTA or '',
-                        fmt % (i + firstlineno),
-                        i == info.index and '> ' or ': ', line, self.NORMAL])
-                self.writer.write(s.chunks)
+                self.writer.write(self.build_exception(
+                    self.indent, func_name, evalue, etb.tb_next, timing))
                 raise
 
-            # Display the return value.
+            # Display the return value, or trace the generator or coroutine.
             self.indent -= 2
-            s = self.Stanza(self.indent)
-            s.add([self.GREEN, '-> ', self.CYAN, self.safe_repr(result),
-                   self.NORMAL])
-            self.writer.write(s.chunks)
+            if body_tracer:
+                return body_tracer(
+                    self, result, func_name, where, self.indent + 2, stats)
+            if timed:
+                timing = self.stop_timer(timer, stats)
+            self.emit(self.build_return, self.indent, func_name, where,
+                      self.snapshot([result])[0], timing)
             return result
-        return self.functools.update_wrapper(wrapper, func)
-
-    def __call__(self, *args):
-        """If invoked as a decorator on a function, adds tracing output to the
-        function; otherwise immediately prints out the arguments."""
-        caller_frame = self.sys._getframe(1)
-        info = self.inspect.getframeinfo(caller_frame, context=9)
+        wrapper = self.functools.update_wrapper(wrapper, func)
+        wrapper.q_traced = func
+        if body_tracer is self.TracedCoroutine:
+            self.mark_coroutine_function(wrapper)
+        return wrapper
+
+    def mark_coroutine_function(self, wrapper):
+        """Marks the wrapper of an async def as a coroutine function, since
+        frameworks check for one to decide whether to await what it
+        returns."""
+        mark = getattr(self.inspect, 'markcoroutinefunction', None)
+        if mark:  # Python 3.12+
+            mark(wrapper)
+        else:  # only asyncio.iscoroutinefunction can be told
+            wrapper._is_coroutine = self.asyncio.coroutines._is_coroutine
+
+    # Special methods that trace_class traces; tracing the others (such as
+    # __repr__, which q calls itself) would be more trouble than it's worth.
+    TRACED_SPECIAL_METHODS = ['__init__', '__call__']
+
+    def watch(self, *funcs):
+        """Shows calls to, and returns from, the given functions (or methods
+        or code objects) without wrapping them or changing any source.  The
+        events are buffered and written out every watcher.max_events events
+        and when q.unwatch() is called."""
+        if self.watcher is None:
+            self.watcher = self.Watcher(self)
+        for func in funcs:
+            self.watcher.add(self.get_code(func))
+
+    def unwatch(self, *funcs):
+        """Stops watching the given functions, or all of them if none are
+        given, and writes out what has been recorded."""
+        if self.watcher is not None:
+            codes = [self.get_code(func) for func in funcs] or list(
+                self.watcher.codes)
+            for code in codes:
+                self.watcher.remove(code)
+            self.watcher.flush()
+
+    def get_code(self, func):
+        func = getattr(func, '__func__', func)  # a method
+        func = getattr(func, 'q_traced', func)  # something decorated with @q
+        return getattr(func, '__code__', func)
+
+    def trace_module(self, module, include=None, exclude=None, timed=False):
+        """Traces every function and method defined in a module (but not
+        imported into it) whose name matches include and doesn't match
+        exclude.  These are glob patterns, or lists of them, matched against
+        names like "func" and "Class.method".  Code that got hold of the
+        functions before this call keeps calling them untraced.  Undo this
+        with q.untrace(module)."""
+        instrumented = self.instrumented.setdefault(module, [])
+        for name, value in sorted(vars(module).items()):
+            if getattr(value, '__module__', None) != module.__name__:
+                continue
+            if isinstance(value, type):
+                instrumented.extend(
+                    self.instrument_class(value, include, exclude, timed))
+            elif self.should_trace(value, name, include, exclude):
+                instrumented.append(
+                    self.instrument(module, name, value, value, timed))
+
+    def trace_class(self, cls, include=None, exclude=None, timed=False):
+        """Traces every method (including static and class methods) of a
+        class whose name matches include and doesn't match exclude, as for
+        trace_module.  Undo this with q.untrace(cls)."""
+        self.instrumented.setdefault(cls, []).extend(
+            self.instrument_class(cls, include, exclude, timed))
+
+    def instrument_class(self, cls, include, exclude, timed):
+        instrumented = []
+        for name, value in sorted(vars(cls).items()):
+            if name.startswith('__') and name.endswith('__') and (
+                    name not in self.TRACED_SPECIAL_METHODS):
+                continue
+            func = getattr(value, '__func__', value)  # unwrap @staticmethod
+            if self.should_trace(
+                    func, cls.__name__ + '.' + name, include, exclude):
+                instrumented.append(
+                    self.instrument(cls, name, value, func, timed))
+        return instrumented
+
+    def should_trace(self, func, name, include, exclude):
+        if not hasattr(func, '__code__') or hasattr(func, 'q_traced'):
+            return False  # not a Python function, or already traced
+        match = self.fnmatch.fnmatchcase
+        if isinstance(include, self.BASESTRING_TYPES):
+            include = [include]
+        if isinstance(exclude, self.BASESTRING_TYPES):
+            exclude = [exclude]
+        return (not include or any(match(name, p) for p in include)) and (
+            not any(match(name, p) for p in exclude or []))
+
+    def instrument(self, owner, name, value, func, timed):
+        """Replaces owner.name, which is value, with a traced version of
+        func (the function that value is or wraps)."""
+        traced = self.trace(func, timed)
+        if value is not func:
+            traced = type(value)(traced)  # a staticmethod or classmethod
+        setattr(owner, name, traced)
+        return owner, name, value, traced
+
+    def untrace(self, target=None):
+        """Puts back what trace_module(target) or trace_class(target)
+        replaced, or what all calls to them replaced if target is None.
+        Functions that have since been replaced by something else are left
+        alone."""
+        targets = target is None and list(self.instrumented) or [target]
+        for target in targets:
+            for owner, name, value, traced in reversed(
+                    self.instrumented.pop(target, [])):
+                if vars(owner).get(name) is traced:
+                    setattr(owner, name, value)
+
+    def timed(self, func):
+        """Decorator to trace a function and time its calls."""
+        return self.trace(func, timed=True)
+
+    def get_timing_stats(self, name):
+        if not self.timings:
+            self.atexit.register(self.dump_timings)
+        if name not in self.timings:
+            self.timings[name] = self.TimingStats(name)
+        return self.timings[name]
+
+    def start_timer(self):
+        # Each timed call gets a counter of the time spent in the timed calls
+        # it makes, so that it can tell its own time from theirs.
+        outer = self.context_child_time.get()
+        inner = [0.0]
+        self.context_child_time.set(inner)
+        return outer, inner, self.clock(), self.cpu_clock()
+
+    def read_timer(self, timer):
+        """Stops a timer, and gets the wall, CPU and self time it measured."""
+        wall, cpu = self.clock(), self.cpu_clock()
+        outer, inner, start, cpu_start = timer
+        wall -= start
+        cpu -= cpu_start
+        self.context_child_time.set(outer)
+        if outer is not None:
+            outer[0] += wall
+        return wall, cpu, wall - inner[0]
+
+    def stop_timer(self, timer, stats):
+        """Adds a timed call to stats, and formats its times for display."""
+        wall, cpu, own = self.read_timer(timer)
+        stats.add(wall, own)
+        return self.format_timing(wall, cpu, own)
+
+    def format_timing(self, wall, cpu, own):
+        return '[%s wall, %s cpu, %s self]' % (
+            self.format_seconds(wall), self.format_seconds(cpu),
+            self.format_seconds(own))
+
+    def format_seconds(self, seconds):
+        if seconds >= 1:
+            return '%.3gs' % seconds
+        if seconds >= 0.001:
+            return '%.3gms' % (seconds * 1e3)
+        return '%.3gus' % (seconds * 1e6)
+
+    def dump_timings(self):
+        """Writes out statistics for all timed functions, slowest first."""
+        all_stats = sorted(self.timings.values(), key=lambda s: -s.total)
+        for stats in all_stats:
+            if not stats.count:
+                continue
+            s = self.Stanza(self.indent)
+            s.add([self.GREEN, stats.name, self.NORMAL, ': '])
+            s.add(['%d calls' % stats.count], wrap=False)
+            for label, seconds in [
+                    ('total', stats.total), ('self', stats.self_total),
+                    ('min', stats.min), ('p50', stats.quantile(0.5)),
+                    ('p99', stats.quantile(0.99)), ('max', stats.max)]:
+                s.add([label, ' ', self.YELLOW, self.format_seconds(seconds),
+                       self.NORMAL], ', ')
+            self.writer.write(s)
+
+    def count(self):
+        """Counts the calls made from each call site, writing out the counts
+        every stats_seconds seconds and at exit instead of every call."""
+        if self.enabled:
+            self.get_site_stats(self.sys._getframe(1), False).hit()
+
+    def stats(self, value):
+        """Keeps statistics on the values passed in at each call site (the
+        count, the min, max, mean and standard deviation of the numbers, and
+        the most frequent values), writing them out every stats_seconds
+        seconds and at exit instead of every value.  Returns the value."""
+        if self.enabled:
+            self.get_site_stats(self.sys._getframe(1), True).add(value)
+        return value
+
+    def get_site_stats(self, caller_frame, labelled):
+        """Gets the statistics for a call site, which is named by the
+        expression passed in, if labelled, or else by its line number."""
+        key = (caller_frame.f_code, caller_frame.f_lasti)
+        stats = self.site_stats.get(key)
+        now = self.clock()
+        if stats is None:
+            if not self.site_stats:
+                self.atexit.register(self.dump_stats)
+            code = caller_frame.f_code
+            label = 'line %d' % caller_frame.f_lineno
+            if labelled:
+                labels = self.get_call_site(caller_frame)[1]
+                label = labels and labels[0] or label
+            stats = self.SiteStats('%s: %s' % (code.co_name, label))
+            stats.last_summary = now
+            # Another thread may have just added the site, too.
+            stats = self.site_stats.setdefault(key, stats)
+        elif now - stats.last_summary >= self.stats_seconds:
+            stats.last_summary = now
+            self.write_site_stats(stats)
+        return stats
+
+    def dump_stats(self):
+        """Writes out the statistics for every call site of q.count() and
+        q.stats()."""
+        for stats in list(self.site_stats.values()):
+            self.write_site_stats(stats)
+
+    def write_site_stats(self, stats):
+        count, numbers, top = stats.summary()
+        s = self.Stanza(self.indent)
+        s.add([self.GREEN, stats.name, self.NORMAL, ': '])
+        s.add(['%d calls' % count], wrap=False)
+        if numbers:
+            for label, number in zip(['min', 'mean', 'sd', 'max'], numbers):
+                s.add([label, ' ', self.CYAN, '%.6g' % number, self.NORMAL],
+                      ', ')
+        sep = '; top '
+        for value, count, error in top:
+            s.add([self.CYAN, self.safe_repr(value, 40), self.NORMAL,
+                   error and ' (~%d)' % count or ' (%d)' % count], sep)
+            sep = ', '
+        self.writer.write(s)
+
+    def get_context(self, filename, lineno, context, frame):
+        """Gets (lines, index) for `context` lines of source around lineno,
+        like inspect.getframeinfo(frame, context) but without its overhead
+        (which it still falls back on, e.g. for zipped modules)."""
+        result = self.source_cache.get_context(filename, lineno, context)
+        if result is None:
+            info = self.inspect.getframeinfo(frame, context=context)
+            result = info.code_context, info.index
+        return result
 
-        # info.index is the index of the line containing the end of the call
+    # How the lines that decorators come before start.
+    DEF_STARTS = ('def ', 'async def ', 'class ')
+
+    def get_call_site(self, caller_frame):
+        """Gets (function name, labels, is_decorator) for a call to q()."""
+        # Parsing the source and disassembling the caller is expensive, so
+        # the result is cached per call site and reused until the source
+        # file changes on disk.
+        code = caller_frame.f_code
+        key = (code, caller_frame.f_lasti)
+        mtime = self.source_cache.get_mtime(code.co_filename)
+        entry = self.label_cache.get(key)
+        if entry and entry[0] == mtime:
+            return entry[1:]
+
+        code_context, index = self.get_context(
+            code.co_filename, caller_frame.f_lineno, 9, caller_frame)
+
+        # index is the index of the line containing the end of the call
         # expression, so this gets a few lines up to the end of the expression.
         lines = ['']
-        if info.code_context:
-            lines = info.code_context[:info.index + 1]
-
-        # If we see "@q" on a single line, behave like a trace decorator.
-        for line in lines:
-            if line.strip() in ('@q', '@q()') and args:
-                return self.trace(args[0])
+        if code_context:
+            lines = code_context[:index + 1]
+
+        # If the call is on an "@q" line, behave like a trace decorator.
+        # Before Python 3.11, a decorator is called on the def line (3.8 to
+        # 3.10) or the last decorator line, so look up through those to it.
+        is_decorator = False
+        for i, line in enumerate(reversed(lines)):
+            line = line.strip()
+            if line in ('@q', '@q()'):
+                is_decorator = True
+            if is_decorator or not (line.startswith('@') or i == 0 and
+                                    line.startswith(self.DEF_STARTS)):
+                break
 
         # Otherwise, search for the beginning of the call expression; once it
         # parses, use the expressions in the call to label the debugging
         # output.
         for i in range(1, len(lines) + 1):
-            labels = self.get_call_exprs(caller_frame,
-                                         ''.join(lines[-i:]).replace('\n', ''))
+            labels = self.get_call_exprs(
+                caller_frame, ''.join(lines[-i:]).replace('\n', ''))
             if labels:
                 break
-        self.show(info.function, args, labels)
+        site = (code.co_name, labels, is_decorator)
+        self.label_cache.put(key, (mtime,) + site)
+        return site
+
+    def __call__(self, *args):
+        """If invoked as a decorator on a function, adds tracing output to the
+        function; otherwise immediately prints out the arguments."""
+        if not self.enabled:
+            return args and args[0]
+        caller_frame = self.sys._getframe(1)
+        if self.limiter is not None and self.suppress(
+                (caller_frame.f_code, caller_frame.f_lasti),
+                self.describe_frame, caller_frame):
+            return args and args[0]
+        func_name, labels, is_decorator = self.get_call_site(caller_frame)
+        if is_decorator and args:
+            return self.trace(args[0])
+        self.show(func_name, args, labels,
+                  (caller_frame.f_code.co_filename, caller_frame.f_lineno))
         return args and args[0]
 
     def __truediv__(self, arg):  # a tight-binding operator
         """Prints out and returns the argument."""
-        info = self.inspect.getframeinfo(self.sys._getframe(1))
-        self.show(info.function, [arg])
+        if not self.enabled:
+            return arg
+        caller_frame = self.sys._getframe(1)
+        if self.limiter is not None and self.suppress(
+                (caller_frame.f_code, caller_frame.f_lasti),
+                self.describe_frame, caller_frame):
+            return arg
+        code = caller_frame.f_code
+        self.show(code.co_name, [arg], None,
+                  (code.co_filename, caller_frame.f_lineno))
         return arg
     # Compat for Python 2 without from future import __division__ turned on
     __div__ = __truediv__
@@ -470,11 +3363,13 @@ class Q(object):
 
     def d(self, depth=1):
         """Launches an interactive console at the point where it's called."""
-        info = self.inspect.getframeinfo(self.sys._getframe(1))
+        if not self.enabled:
+            return
+        func_name = self.sys._getframe(1).f_code.co_name
         s = self.Stanza(self.indent)
-        s.add([info.function + ': '])
+        s.add([func_name + ': '])
         s.add([self.MAGENTA, 'Interactive console opened', self.NORMAL])
-        self.writer.write(s.chunks)
+        self.writer.write(s)
 
         frame = self.sys._getframe(depth)
         env = frame.f_globals.copy()
@@ -482,17 +3377,19 @@ class Q(object):
         self.indent += 2
         self.in_console = True
         self.code.interact(
-            'Python console opened by q.d() in ' + info.function, local=env)
+            'Python console opened by q.d() in ' + func_name, local=env)
         self.in_console = False
         self.indent -= 2
 
         s = self.Stanza(self.indent)
-        s.add([info.function + ': '])
+        s.add([func_name + ': '])
         s.add([self.MAGENTA, 'Interactive console closed', self.NORMAL])
-        self.writer.write(s.chunks)
+        self.writer.write(s)
 
 
 # Install the Q() object in sys.modules so that "import q" gives a callable q.
 q = Q()
-q.long
 sys.modules['q'] = q
+
+if __name__ == '__main__':
+    q.main(sys.argv[1:])
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et sts=4 ai:
+#
+# Measure the overhead of q's entry points.
+#
+# Each benchmark runs at a "warm" call site (called over and over, so q's
+# caches are full) and, where it matters, at a "cold" one (q's caches are
+# cleared before every call, as for the first call from a new site).
+#
+# Usage:
+#     python test/benchmark.py [-o results.json] [-c baseline.json] [names]
+#
+# With -o, results are saved as JSON; with -c, they are compared against
+# results saved earlier, so that regressions between versions stand out.
+# With -m, the peak memory allocated per call is measured instead of time
+# (this needs Python 3.9 or later).
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+qpath = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..'))
+sys.path.insert(0, qpath)
+
+import q  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def clear_caches():
+    q.label_cache.clear()
+    q.call_positions.clear()
+    q.source_cache.files.clear()
+    q.source_cache.mtimes.clear()
+
+
+# The call sites being measured.  They have to live in a real source file,
+# since q reads the source to label its output.
+
+def bare(x):
+    return x
+
+
+def call_q(x):
+    return q(x)
+
+
+def call_q_multiple_args(x, y, z):
+    return q(x, y, z)
+
+
+def call_q_multiline(x, y, z):
+    return q(x,
+             y,
+             z)
+
+
+def call_q_count(x):
+    q.count()
+    return x
+
+
+def call_q_stats(x):
+    return q.stats(x)
+
+
+def call_q_div(x):
+    return q/x
+
+
+def call_q_or(x):
+    return q | x
+
+
+@q
+def traced(x):
+    return x
+
+
+@q
+def traced_raise(x):
+    raise ValueError(x)
+
+
+def call_traced_raise(x):
+    try:
+        traced_raise(x)
+    except ValueError:
+        pass
+
+
+def watched(x):
+    return x
+
+
+def run_python(code):
+    subprocess.check_call([sys.executable, '-c', code], cwd=qpath)
+
+
+def write_record(record):
+    q.writer.write(record)
+
+
+LARGE_LIST = list(range(10000))
+NESTED_DICT = dict(('key%d' % i, {'a': [i, i + 1], 'b': {'c': str(i)}})
+                   for i in range(1000))
+LONG_STRING = 'x' * 100000
+# Records as they are written out, after their values have been repr'd.
+MANY_ARGS_RECORD = {
+    'kind': 'call', 'indent': 4, 'function': 'func',
+    'labels': ['arg%d' % i for i in range(50)],
+    'reprs': [repr('value %d' % i) for i in range(50)]}
+MULTILINE_RECORD = {
+    'kind': 'value', 'indent': 4, 'function': 'func', 'labels': ['text'],
+    'reprs': ['\n'.join('line %d' % i for i in range(10000))]}
+
+BENCHMARKS = [
+    # (name, function, args, whether to also measure at a cold call site,
+    #  'enabled', 'disabled', 'watching' to run with q.watch(watched), or
+    #  'sink' to stream the log to a collector with q.sink())
+    ('q(x)', call_q, (1,), True, 'enabled'),
+    ('q(x, y, z)', call_q_multiple_args, (1, 2, 3), True, 'enabled'),
+    ('q(x,\\n y,\\n z)', call_q_multiline, (1, 2, 3), True, 'enabled'),
+    ('q/x', call_q_div, (1,), True, 'enabled'),
+    ('q|x', call_q_or, (1,), True, 'enabled'),
+    ('q(x) to a socket sink', call_q, (1,), False, 'sink'),
+    ('q.count()', call_q_count, (1,), False, 'enabled'),
+    ('q.stats(x)', call_q_stats, (1,), False, 'enabled'),
+    ('@q', traced, (1,), False, 'enabled'),
+    ('@q raising', call_traced_raise, (1,), True, 'enabled'),
+    ('safe_repr(large list)', q.safe_repr, (LARGE_LIST,), False, 'enabled'),
+    ('safe_repr(nested dict)', q.safe_repr, (NESTED_DICT,), False, 'enabled'),
+    ('safe_repr(long string)', q.safe_repr, (LONG_STRING,), False, 'enabled'),
+    ('write record (50 args)', write_record, (MANY_ARGS_RECORD,), False,
+     'enabled'),
+    ('write record (10000 lines)', write_record, (MULTILINE_RECORD,), False,
+     'enabled'),
+    # With q disabled, compared to calling a function that does nothing.
+    ('bare function call', bare, (1,), False, 'enabled'),
+    ('q(x) disabled', call_q, (1,), False, 'disabled'),
+    ('q/x disabled', call_q_div, (1,), False, 'disabled'),
+    ('@q disabled at run time', traced, (1,), False, 'disabled'),
+    # Watching one function, compared to the calls that aren't watched.
+    ('q.watch()ed function', watched, (1,), False, 'watching'),
+    ('bare call while watching', bare, (1,), False, 'watching'),
+    # Starting Python and importing q, compared to just starting Python.
+    ('python startup', run_python, ('pass',), False, 'enabled'),
+    ('python startup + import q', run_python, ('import q',), False, 'enabled'),
+]
+
+
+def measure(func, args, cold, min_time=0.2, repeat=3):
+    """Gets the best time per call, in seconds, over `repeat` runs of at
+    least min_time seconds each."""
+    # Time slow functions one call at a time, and fast ones in batches.
+    start = clock()
+    func(*args)
+    batch = clock() - start > 1e-3 and 1 or 100
+    best = None
+    for i in range(repeat):
+        number = total = 0
+        while total < min_time:
+            if cold:
+                clear_caches()
+                start = clock()
+                func(*args)
+                total += clock() - start
+                number += 1
+            else:
+                start = clock()
+                for j in range(batch):
+                    func(*args)
+                total += clock() - start
+                number += batch
+        if best is None or total / number < best:
+            best = total / number
+    return best
+
+
+def measure_memory(func, args, cold):
+    """Gets the peak memory allocated while func runs, in bytes."""
+    import tracemalloc
+    func(*args)
+    tracemalloc.start()
+    try:
+        if cold:
+            clear_caches()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def start_sink(tempdir):
+    """Streams the log to a collector running on a thread."""
+    address = 'unix:' + os.path.join(tempdir, 'socket')
+    collector = q.Collector(*q.parse_address(address),
+                            path=os.path.join(tempdir, 'collected'))
+    thread = threading.Thread(target=collector.run, args=(0.01,))
+    thread.start()
+    q.sink(address)
+    return collector, thread
+
+
+def stop_sink(tempdir, collector, thread):
+    q.sink()
+    q.writer.file_writer = q.FileWriter(os.path.join(tempdir, 'q'))
+    collector.stop()
+    thread.join()
+    collector.close()
+
+
+def format_seconds(seconds):
+    if seconds >= 1e-3:
+        return '%8.2f ms' % (seconds * 1e3)
+    return '%8.2f us' % (seconds * 1e6)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks for q.')
+    parser.add_argument('names', nargs='*', help=(
+        'run only benchmarks whose names contain one of these'))
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-c', '--compare', help=(
+        'compare with results saved earlier with -o'))
+    parser.add_argument('-m', '--memory', action='store_true', help=(
+        'measure the peak memory allocated per call instead of time'))
+    args = parser.parse_args(argv)
+
+    # Keep the benchmarks from writing to the real log.
+    tempdir = tempfile.mkdtemp()
+    q.writer.file_writer = q.FileWriter(os.path.join(tempdir, 'q'))
+    q.spill_store = q.SpillStore(os.path.join(tempdir, 'q'), q.FileWriter)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+    try:
+        for name, func, func_args, cold, mode in BENCHMARKS:
+            if args.names and not any(n in name for n in args.names):
+                continue
+            for site in cold and ['warm', 'cold'] or ['warm']:
+                key = '%s [%s]' % (name, site)
+                q.enabled = mode != 'disabled'
+                if mode == 'watching':
+                    q.watch(watched)
+                sink = mode == 'sink' and start_sink(tempdir)
+                try:
+                    results[key] = (args.memory and measure_memory or
+                                    measure)(func, func_args, site == 'cold')
+                finally:
+                    q.enabled = True
+                    q.unwatch()
+                    if sink:
+                        stop_sink(tempdir, *sink)
+                line = '%-34s %s' % (key, args.memory and (
+                    '%8.1f KB' % (results[key] / 1024.0)) or
+                    format_seconds(results[key]))
+                if key in baseline:
+                    line += '  (%.2fx)' % (results[key] / baseline[key])
+                print(line)
+                # Start each benchmark with an empty log.
+                open(q.writer.file_writer.path, 'w').close()
+    finally:
+        shutil.rmtree(tempdir)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': platform.python_version(),
+                       'implementation': platform.python_implementation(),
+                       'time': time.time(),
+                       'results': results}, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,11 +4,21 @@
 # Test some basic functionality.
 #
 
+import json
 import os
 import re
+import shutil
+import signal
+import subprocess
 import sys
+import tempfile
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 qpath = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..'))
 sys.path.insert(0, qpath)
 
@@ -22,6 +32,10 @@ class TestQBasic(unittest.TestCase):
     def tearDown(self):
         self.setUp()
 
+    def read_log(self, path='/tmp/q'):
+        with open(path) as f:
+            return f.read()
+
     def assertInQLog(self, string):
         # Check the log file exists.
         self.assertTrue(os.path.exists('/tmp/q'))
@@ -61,6 +75,18 @@ class TestQBasic(unittest.TestCase):
         self.assertInQLog('ArgVal')
         self.assertInQLog('RetVal')
 
+    def test_q_stanza(self):
+        import q
+        q.writer.color = False
+        s = q.Stanza(2, width=25)
+        s.add([q.CYAN, 'first\nline', q.NORMAL])
+        s.add(['second', 3], ', ')
+        s.add([q.RED, 'wrapped', q.NORMAL], ', ')
+        self.assertEqual(s.escapes, [2, 4, 9, 11])
+        self.assertEqual(sorted(s.breaks), [3, 8])
+        q.writer.write(s)
+        self.assertInQLog(r"s   first\n +line, second3,\n +wrapped\n")
+
     def test_q_argument_order_arguments(self):
         import q
         q.writer.color = False
@@ -158,6 +184,744 @@ class TestQBasic(unittest.TestCase):
             "self.attrib2='Attrib2'",
         ]))
 
+    def test_q_label_cache(self):
+        import q
+        q.writer.color = False
+        q.label_cache.clear()
+
+        for value in ['Value1', 'Value2', 'Value3']:
+            q(value)
+
+        self.assertEqual(q.label_cache.misses, 1)
+        self.assertEqual(q.label_cache.hits, 2)
+        self.assertInQLog(".*".join([
+            "value='Value1'",
+            "value='Value2'",
+            "value='Value3'",
+        ]))
+
+    def test_q_buffered(self):
+        import q
+        q.writer.color = False
+        q.buffered(max_delay=60)
+        try:
+            q('Buffered1')
+            self.assertFalse(os.path.exists('/tmp/q'))
+            q.writer.file_writer.flush()
+            self.assertInQLog('Buffered1')
+
+            # The file is reopened if it is deleted (or rotated) under us.
+            os.remove('/tmp/q')
+            q('Buffered2')
+            q.writer.file_writer.flush()
+            self.assertInQLog('Buffered2')
+        finally:
+            q.unbuffered()
+
+    def test_q_background(self):
+        import q
+        q.writer.color = False
+        q.background()
+        try:
+            q('Background1')
+            q('Background2')
+        finally:
+            q.foreground()
+        self.assertInQLog('Background1.*Background2')
+
+        q.background(max_queue=0)
+        try:
+            q('Dropped')
+        finally:
+            q.foreground()
+        self.assertEqual(q.writer.dropped, 1)
+
+    def test_q_thread_indent(self):
+        import threading
+        import q
+        q.writer.color = False
+
+        def worker(message):
+            q(message)
+
+        @q
+        def traced(message):
+            thread = threading.Thread(
+                target=worker, args=('InWorker',), name='QWorker')
+            thread.start()
+            thread.join()
+            q(message)
+
+        traced('InTraced')
+        self.assertInQLog(r"s \[QWorker\] worker: message='InWorker'")
+        self.assertInQLog(r"s   traced: message='InTraced'")
+
+    def test_q_lazy(self):
+        import q
+        q.writer.color = False
+        q.lazy = True
+        q.background()
+        try:
+            @q
+            def lazy_func(arg):
+                return 'LazyResult'
+
+            lazy_func('LazyArg')
+        finally:
+            q.foreground()
+            q.lazy = False
+        self.assertInQLog(r"lazy_func\('LazyArg'\).*-> 'LazyResult'")
+
+    def test_q_record_budget(self):
+        import q
+        q.writer.color = False
+        q.max_record_length = 20
+        try:
+            q('A' * 10, 'B' * 20, 'C' * 30)
+        finally:
+            q.max_record_length = None
+        self.assertInQLog(r"'AAAAAAAAAA'")
+        self.assertInQLog(r"'BBBBBBB\.\.\.\[truncated\]")
+        self.assertInQLog(r"<str len=30 at 0x[0-9a-f]+>\.\.\.\[truncated\]")
+
+    def test_q_repr(self):
+        import q
+        cycle = [1]
+        cycle.append(cycle)
+
+        class Sub(list):
+            pass
+
+        values = [
+            'a\nb', b'ab', (1,), set(), {'a': [1, (2,)]}, cycle, Sub([1])]
+        for value in values:
+            self.assertEqual(q.safe_repr(value), repr(value))
+        self.assertEqual(q.safe_repr('a\\b'), r"r'a\b'")
+        self.assertEqual(q.safe_repr(object()), '<object object>')
+
+        # The repr stops once it runs out of room, even for huge values.
+        self.assertEqual(
+            q.safe_repr(list(range(10 ** 6)), 10), '[0, 1, 2, ...')
+        self.assertEqual(q.safe_repr({'k': 'x' * 10 ** 6}, 8), "{'k': 'x...")
+
+        repr_ = q.Repr(100, max_items=2, max_level=1, max_string=3)
+        self.assertEqual(repr_.repr([1, 2, 3]), '[1, 2, ...]')
+        self.assertEqual(repr_.repr({1: 2, 3: 4}), '{1: 2, 3: 4}')
+        self.assertEqual(repr_.repr([[1]]), '[[...]]')
+        self.assertEqual(repr_.repr('abcdef'), "'abc'...")
+
+    def test_q_short(self):
+        # q.short keeps the limits of pydoc's TextRepr.
+        import q
+        q.short
+        try:
+            self.assertEqual(q.safe_repr(list(range(30))), repr(
+                list(range(20)))[:-1] + ', ...]')
+            self.assertEqual(q.safe_repr(dict.fromkeys(range(15), 0)), repr(
+                dict.fromkeys(range(10), 0))[:-1] + ', ...}')
+            self.assertEqual(q.safe_repr('x' * 60), repr('x' * 60))
+            self.assertTrue(q.safe_repr('x' * 120).startswith(
+                repr('x' * 100) + '...'))
+        finally:
+            q.long
+        self.assertEqual(q.safe_repr(list(range(30))), repr(list(range(30))))
+
+    def test_q_repr_collections(self):
+        import array
+        import collections
+        import q
+
+        class Counter(collections.Counter):
+            pass
+
+        values = [
+            collections.Counter('abracadabra'), Counter('aab'),
+            collections.Counter(), collections.Counter({'a': 1, 'b': 'x'}),
+            collections.OrderedDict([('a', 1), ('b', [2, (3,)])]),
+            collections.OrderedDict(),
+            collections.defaultdict(list, {1: [2]}),
+            collections.defaultdict(int),
+            collections.deque([1, 2, 3], maxlen=5), collections.deque(),
+            array.array('i', [1, 2]), array.array('d', [1.5]),
+            array.array('i')]
+        for value in values:
+            self.assertEqual(q.safe_repr(value), repr(value))
+
+        # Huge ones are formatted only as far as the budget goes.
+        self.assertEqual(
+            q.safe_repr(collections.Counter(range(10 ** 6)), 16),
+            'Counter({0: 1, 1...')
+        self.assertEqual(
+            q.safe_repr(collections.deque(range(10 ** 6), 10 ** 6), 10),
+            'deque([0, ...')
+        self.assertEqual(
+            q.safe_repr(array.array('i', range(10 ** 6)), 16),
+            "array('i', [0, 1...")
+
+        class Huge(object):
+            def __len__(self):
+                return 10 ** 6
+
+            def __iter__(self):
+                return iter(range(10 ** 6))
+
+            def __repr__(self):
+                raise AssertionError('repr of a huge container')
+
+        self.assertEqual(q.safe_repr(Huge(), 100), '<Huge len=1000000>')
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_q_repr_numpy(self):
+        import q
+        self.assertEqual(q.safe_repr(numpy.zeros(3)), repr(numpy.zeros(3)))
+        self.assertEqual(
+            q.safe_repr(numpy.arange(1000).reshape(100, 10)),
+            'array([0, 1, 2, 3, 4, 5, ...], shape=(100, 10), dtype=int64)')
+
+    def test_q_sample(self):
+        import q
+        q.writer.color = False
+        q.sample(every=3, first=2)
+        try:
+            for i in range(10):
+                q('Sample%d' % i)
+        finally:
+            q.sample()
+        logdata = self.read_log()
+        self.assertEqual(re.findall('Sample\\d', logdata), [
+            'Sample0', 'Sample1', 'Sample2', 'Sample5', 'Sample8'])
+        self.assertInQLog('suppressed 5 records')
+
+    def test_q_rate_limit(self):
+        import q
+        q.writer.color = False
+        q.rate_limit(per_second=1, burst=2)
+        try:
+            @q
+            def limited(arg):
+                return arg
+
+            for i in range(5):
+                limited('Limited%d' % i)
+        finally:
+            q.rate_limit()
+        logdata = self.read_log()
+        self.assertEqual(re.findall('Limited\\d', logdata), [
+            'Limited0', 'Limited0', 'Limited1', 'Limited1'])
+        self.assertInQLog('limited: suppressed 3 records')
+
+    def test_q_timed(self):
+        import q
+        q.writer.color = False
+
+        @q.timed
+        def timed_inner(arg):
+            return arg
+
+        @q.timed
+        def timed_outer(arg):
+            return timed_inner(arg)
+
+        for i in range(3):
+            timed_outer('Timed')
+        self.assertInQLog(r"-> 'Timed' \[\S+ wall, \S+ cpu, \S+ self\]")
+
+        [stats] = [stats for name, stats in q.timings.items()
+                   if name.endswith('timed_outer')]
+        self.assertEqual(stats.count, 3)
+        self.assertLessEqual(stats.self_total, stats.total)
+        q.dump_timings()
+        self.assertInQLog(r"timed_outer: 3 calls,\s+total \S+,\s+self \S+,"
+                          r"\s+min \S+,\s+p50 \S+,\s+p99 \S+,\s+max \S+")
+
+    def test_q_stats(self):
+        import q
+        q.writer.color = False
+        q.site_stats.clear()
+        for i in range(1000):
+            q.count()
+            q.stats(i % 4 + 1)
+            q.stats(str(i))
+        self.assertFalse(os.path.exists('/tmp/q'))
+        q.dump_stats()
+        q.site_stats.clear()
+        self.assertInQLog(r"test_q_stats: line \d+: 1000 calls\n")
+        self.assertInQLog(r"test_q_stats: i % 4 \+ 1: 1000 calls, min 1, "
+                          r"mean 2.5, sd 1.11\d*, max 4; top\s+\d \(250\), "
+                          r"\d \(250\), \d \(250\), \d \(250\)\n")
+        self.assertInQLog(r"test_q_stats: str\(i\): 1000 calls\n")
+
+        stats = q.SiteStats('values', size=3)
+        for value in [1, 1, 1, 2, 2, 3, 4, 5, 5, 5, [1]]:
+            stats.add(value)
+        self.assertEqual(stats.top(), [(5, 5, 2), (1, 3, 0)])
+
+    def test_q_stats_threads(self):
+        import threading
+        import q
+        q.writer.color = False
+        q.site_stats.clear()
+        errors = []
+
+        def worker():
+            try:
+                for i in range(5000):
+                    q.count()
+                    q.stats(i % 13)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counts = sorted(stats.count for stats in q.site_stats.values())
+        q.site_stats.clear()
+        self.assertEqual(errors, [])
+        self.assertEqual(counts, [40000, 40000])
+
+    def test_q_json_lines(self):
+        import q
+        q.writer.color = False
+        if os.path.exists('/tmp/q.jsonl'):
+            os.remove('/tmp/q.jsonl')
+        q.json_lines(path='/tmp/q.jsonl')
+        try:
+            @q
+            def json_func(arg, kwarg=None):
+                return arg
+
+            json_func('JsonArg', kwarg=1)
+            q('JsonValue')
+        finally:
+            q.json_lines(False)
+        self.assertInQLog("json_func\\('JsonArg', kwarg=1\\)")
+
+        records = [json.loads(line)
+                   for line in self.read_log('/tmp/q.jsonl').splitlines()]
+        self.assertEqual([r['kind'] for r in records],
+                         ['call', 'return', 'value'])
+        self.assertEqual(records[0]['labels'], [None, 'kwarg'])
+        self.assertEqual(records[0]['reprs'], ["'JsonArg'", '1'])
+        self.assertEqual(records[1]['reprs'], ["'JsonArg'"])
+        self.assertEqual(records[2]['reprs'], ["'JsonValue'"])
+        for record in records:
+            self.assertEqual(record['pid'], os.getpid())
+            self.assertTrue(record['file'].endswith('test_basic.py'))
+            self.assertIn('monotonic', record)
+
+        output = subprocess.check_output([
+            sys.executable, os.path.join(qpath, 'q.py'), '/tmp/q.jsonl',
+            '--kind', 'call', '--no-color']).decode('utf-8')
+        os.remove('/tmp/q.jsonl')
+        self.assertTrue(re.search(r"json_func\('JsonArg', kwarg=1\)", output))
+        self.assertNotIn('JsonValue', output)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "requires os.fork")
+    def test_q_multiprocess(self):
+        import q
+        q.writer.color = False
+        q.multiprocess()
+        try:
+            pid = os.fork()
+            if not pid:
+                q('FromChild')
+                os._exit(0)
+            os.waitpid(pid, 0)
+            q('FromParent')
+        finally:
+            q.multiprocess(False)
+        self.assertInQLog(r"\[pid %d\] .*FromChild" % pid)
+        self.assertInQLog(r"\[pid %d\] .*FromParent" % os.getpid())
+
+    @unittest.skipIf(not hasattr(os, 'register_at_fork'),
+                     "requires os.register_at_fork")
+    def test_q_multiprocess_per_process(self):
+        import q
+        q.writer.color = False
+        q.multiprocess(per_process=True)
+        try:
+            pid = os.fork()
+            if not pid:
+                q('PerProcessChild')
+                os._exit(0)
+            os.waitpid(pid, 0)
+            q('PerProcessParent')
+        finally:
+            q.multiprocess(False)
+        paths = ['/tmp/q.%d' % pid, '/tmp/q.jsonl.%d' % pid,
+                 '/tmp/q.%d' % os.getpid(), '/tmp/q.jsonl.%d' % os.getpid()]
+        try:
+            self.assertIn('PerProcessChild', self.read_log(paths[0]))
+            self.assertIn('PerProcessParent', self.read_log(paths[2]))
+            output = subprocess.check_output([
+                sys.executable, os.path.join(qpath, 'q.py'), '--no-color',
+                paths[1], paths[3]]).decode('utf-8')
+            self.assertTrue(re.search(
+                'PerProcessChild.*PerProcessParent', output, re.DOTALL))
+        finally:
+            for path in paths:
+                os.remove(path)
+
+    def test_q_spill_store(self):
+        import q
+        q.writer.color = False
+        store = q.spill_store
+        q.spill_store = q.SpillStore('/tmp/qtest', q.FileWriter, max_files=2)
+        try:
+            for i in [1, 2, 1, 3]:
+                q('Spilled%d ' % i * 20)
+            urls = re.findall(r'\((file://[^)]*)\)', self.read_log())
+            self.assertEqual(len(urls), 4)
+            self.assertEqual(urls[0], urls[2])  # same content, same file
+            self.assertEqual(len(set(urls)), 3)
+            # Spilled2 was the least recently used, so it was evicted.
+            self.assertFalse(os.path.exists(urls[1][len('file://'):]))
+            self.assertEqual(q.spill_store.read(urls[3]), b'Spilled3 ' * 20)
+
+            q.spill_store.pack = True
+            q('Packed ' * 20)
+            url = re.findall(r'\((file://[^)]*)\)', self.read_log())[-1]
+            self.assertIn('/tmp/qtest.blob#', url)
+            self.assertEqual(q.spill_store.read(url), b'Packed ' * 20)
+        finally:
+            for path in list(q.spill_store.files) + [
+                    '/tmp/qtest.blob', '/tmp/qtest.blob.idx']:
+                os.remove(path)
+            q.spill_store = store
+
+    def test_q_spill_stream(self):
+        import q
+        q.writer.color = False
+        store = q.spill_store
+        q.spill_store = q.SpillStore('/tmp/qtest', q.FileWriter)
+        big = dict(('StreamKey%d' % i, [i] * 10) for i in range(1000))
+        try:
+            q(big)
+            log = self.read_log()
+            url = re.findall(r'\((file://[^)]*)\)', log)[-1]
+            # Only the beginning of the repr is in the log.
+            self.assertTrue(0 < log.count('StreamKey') < 1000)
+            self.assertEqual(q.spill_store.read(url),
+                             repr(big).encode('utf-8'))
+
+            q.spill_store.pack = True
+            q(big)
+            url = re.findall(r'\((file://[^)]*)\)', self.read_log())[-1]
+            self.assertIn('/tmp/qtest.blob#', url)
+            self.assertEqual(q.spill_store.read(url),
+                             repr(big).encode('utf-8'))
+        finally:
+            for path in list(q.spill_store.files) + [
+                    '/tmp/qtest.blob', '/tmp/qtest.blob.idx']:
+                os.remove(path)
+            q.spill_store = store
+
+    @unittest.skipIf(sys.version_info < (3, 4), "requires tracemalloc")
+    def test_q_spill_stream_memory(self):
+        # Streaming a big repr doesn't build it in memory first.
+        import collections
+        import tracemalloc
+        import q
+        q.writer.color = False
+        store = q.spill_store
+        tempdir = tempfile.mkdtemp()
+        q.spill_store = q.SpillStore(os.path.join(tempdir, 'q'), q.FileWriter)
+        values = [
+            collections.deque(range(300000)),
+            collections.Counter(dict(
+                ('StreamCounterKey%d' % i, i) for i in range(100000)))]
+        try:
+            for value in values:
+                size = len(repr(value))
+                q(value)  # to import and set up everything it uses first
+                tracemalloc.start()
+                try:
+                    q(value)
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+                url = re.findall(r'\((file://[^)]*)\)', self.read_log())[-1]
+                self.assertEqual(q.spill_store.read(url),
+                                 repr(value).encode('utf-8'))
+                # At most a few chunks of the repr are in memory at once
+                # (and, for a Counter, a list of its keys in order).
+                self.assertLess(peak, size * 2 // 3)
+        finally:
+            q.spill_store = store
+            shutil.rmtree(tempdir)
+
+    def test_q_spill_stream_unwritable(self):
+        import q
+        q.writer.color = False
+        store = q.spill_store
+        tempdir = tempfile.mkdtemp()
+        try:
+            # Without a place to spill to, the log just gets the beginning.
+            q.spill_store = q.SpillStore(
+                os.path.join(tempdir, 'missing', 'q'), q.FileWriter)
+            q(list(range(20000)))
+            self.assertInQLog(r'\[0, 1, 2, .*\.\.\.\n')
+            with open('/tmp/q') as file:
+                self.assertNotIn('file://', file.read())
+
+            # The temporary file is cleaned up if the repr fails.
+            q.spill_store = q.SpillStore(
+                os.path.join(tempdir, 'q'), q.FileWriter)
+
+            def generate(write):
+                write('Partial')
+                raise ValueError('Unreprable')
+            self.assertRaises(
+                ValueError, q.spill_store.store_stream, generate)
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            q.spill_store = store
+            shutil.rmtree(tempdir)
+
+    def test_q_sink(self):
+        import threading
+        import q
+        q.writer.color = False
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'collected')
+        for address in ['unix:' + os.path.join(tempdir, 'socket'),
+                        '127.0.0.1:0']:
+            collector = q.Collector(*q.parse_address(address), path=path)
+            if isinstance(collector.address, tuple):  # pick up the port
+                address = '127.0.0.1:%d' % collector.address[1]
+            thread = threading.Thread(target=collector.run, args=(0.01,))
+            thread.start()
+            try:
+                q.sink(address)
+                try:
+                    q('Sunk to ' + address)
+                    for i in range(100):
+                        q(i)
+                finally:
+                    q.sink()  # sends everything before switching back
+            finally:
+                collector.stop()
+                thread.join()
+                collector.close()
+            with open(path) as file:
+                content = file.read()
+            self.assertIn("'Sunk to %s'" % address, content)
+            self.assertIn('i=99', content)
+        self.assertFalse(os.path.exists('/tmp/q'))
+        shutil.rmtree(tempdir)
+
+    def test_q_sink_backoff(self):
+        # Writes that fill a batch don't cut short the wait to reconnect.
+        import socket
+        import time
+        import q
+        writer = q.SocketWriter(socket.AF_UNIX, '/nonexistent/socket',
+                                max_size=1, timeout=0.01)
+        sends = []
+        send = writer.send
+        writer.send = lambda: sends.append(1) or send()
+        try:
+            for i in range(100):
+                writer.write('a', 'Waiting%d' % i)
+                time.sleep(0.003)
+        finally:
+            writer.close()
+        self.assertLess(len(sends), 10)
+
+    def test_q_sink_at_exit(self):
+        # The sink stays open for what other at-exit handlers write out.
+        import threading
+        import q
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'collected')
+        address = 'unix:' + os.path.join(tempdir, 'socket')
+        collector = q.Collector(*q.parse_address(address), path=path)
+        thread = threading.Thread(target=collector.run, args=(0.01,))
+        thread.start()
+        try:
+            subprocess.check_call([
+                sys.executable, '-c', 'import q\n'
+                'q.flight_recorder()\n'
+                'q.sink(%r)\n'
+                'q("KeptInRing")' % address], cwd=qpath)
+        finally:
+            collector.stop()
+            thread.join()
+            collector.close()
+        with open(path) as file:
+            self.assertIn('KeptInRing', file.read())
+        shutil.rmtree(tempdir)
+
+    def test_q_sink_with_rotation(self):
+        # A socket sink is never rotated, however rotation gets turned on.
+        tempdir = tempfile.mkdtemp()
+        try:
+            output = subprocess.check_output([
+                sys.executable, '-c', 'import q\n'
+                'writer = q.writer.file_writer\n'
+                'writer.timeout = 0.01  # nothing is listening\n'
+                'q.rotate(max_bytes=100)\n'
+                'q.rotate()\n'
+                'print(q.writer.file_writer is writer and not writer.closed)'
+            ], cwd=qpath, env=dict(
+                os.environ, Q_ROTATE_BYTES='100',
+                Q_SINK='unix:' + os.path.join(tempdir, 'socket')))
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(output.strip(), b'True')
+
+    def test_q_rotate(self):
+        import gzip
+        import q
+        q.writer.color = False
+        paths = ['/tmp/q.1', '/tmp/q.2', '/tmp/q.3', '/tmp/q.1.gz']
+        try:
+            q.rotate(max_bytes=300, backups=2)
+            try:
+                for i in range(30):
+                    q('Rotate%d' % i)
+            finally:
+                q.rotate()
+            self.assertGreaterEqual(os.path.getsize('/tmp/q.1'), 300)
+            self.assertTrue(os.path.exists('/tmp/q.2'))
+            self.assertFalse(os.path.exists('/tmp/q.3'))
+            self.assertInQLog('Rotate29')
+            self.assertNotIn('Rotate29', self.read_log('/tmp/q.1'))
+
+            q.rotate(max_bytes=300, backups=1, compress=True)
+            try:
+                for i in range(10):
+                    q('Compress%d' % i)
+            finally:
+                q.rotate()  # waits for the compressor to finish
+            self.assertFalse(os.path.exists('/tmp/q.1'))
+            with gzip.open('/tmp/q.1.gz') as file:
+                self.assertIn(b'Compress', file.read())
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_q_rotate_counts_bytes(self):
+        import q
+        writer = q.RotatingFileWriter(q.FileWriter('/tmp/q'), max_bytes=1000)
+        writer.write('a', u'\u00e9' * 10)
+        self.assertEqual(writer.size, os.path.getsize('/tmp/q'))
+
+    def test_q_flight_recorder(self):
+        import q
+        q.writer.color = False
+        q.flight_recorder(size=3)
+        try:
+            for i in range(5):
+                q('Ring%d' % i)
+            self.assertFalse(os.path.exists('/tmp/q'))
+            q.dump()
+            self.assertInQLog('dumping the last 3 records.*Ring2.*Ring4')
+            self.assertNotIn('Ring1', self.read_log())
+
+            if hasattr(signal, 'SIGUSR1'):
+                q('Signalled')
+                os.kill(os.getpid(), signal.SIGUSR1)
+                self.assertInQLog('Signalled')
+            q('Stopped')
+        finally:
+            q.flight_recorder(False)
+        self.assertInQLog('Stopped')
+
+        # An unhandled exception dumps the records.
+        tempdir = tempfile.mkdtemp()
+        try:
+            subprocess.call([
+                sys.executable, '-c', 'import q; q.flight_recorder(); '
+                'q.writer.color = False; q("Crashing"); 1/0'],
+                cwd=qpath, env=dict(os.environ, TMPDIR=tempdir),
+                stderr=subprocess.PIPE)
+            self.assertIn('Crashing',
+                          self.read_log(os.path.join(tempdir, 'q')))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_q_source_cache(self):
+        import inspect
+        import q
+
+        def get_frame():
+            return sys._getframe()
+
+        frame = get_frame()  # a finished frame, so f_lineno stays put
+        info = inspect.getframeinfo(frame, context=9)
+        self.assertEqual(q.source_cache.get_context(
+            frame.f_code.co_filename, frame.f_lineno, 9),
+            (info.code_context, info.index))
+
+        # Big files are indexed by line, and survive being truncated while
+        # they're cached.
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'big.py')
+            with open(path, 'w') as file:
+                for i in range(100000):
+                    file.write('x%d = %d\n' % (i, i))
+            self.assertEqual(q.source_cache.get_context(path, 50000, 3),
+                             (['x49998 = 49998\n', 'x49999 = 49999\n',
+                               'x50000 = 50000\n'], 1))
+            self.assertIsNone(q.source_cache.files[path].lines)
+            open(path, 'w').close()
+            # Until the cache notices, it has the old lines.
+            self.assertIn(q.source_cache.get_context(path, 90000, 1),
+                          [(['x89999 = 89999\n'], 0), None])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_q_disabled(self):
+        import q
+        q.writer.color = False
+
+        def undecorated(arg):
+            return arg
+
+        @q
+        def traced_while_enabled(arg):
+            return arg
+
+        q.enabled = False
+        try:
+            self.assertIs(q(undecorated), undecorated)
+            self.assertIs(q.trace(undecorated), undecorated)
+            self.assertEqual(q / 'Disabled1', 'Disabled1')
+            self.assertEqual(q('Disabled2'), 'Disabled2')
+            self.assertEqual(traced_while_enabled('Disabled3'), 'Disabled3')
+        finally:
+            q.enabled = True
+        self.assertFalse(os.path.exists('/tmp/q'))
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'import q; print(q.enabled)'],
+            cwd=qpath, env=dict(os.environ, Q_DISABLE='1'))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_q_lazy_imports(self):
+        # Importing q shouldn't import modules it only needs for some features.
+        lazy = ['ast', 'code', 'dis', 'inspect', 'pydoc', 're', 'shutil',
+                'tempfile']
+        # (Some of them come with the modules q always needs, on older
+        # Pythons, so those are imported first.)
+        output = subprocess.check_output([
+            sys.executable, '-c', 'import atexit, os, sys, threading, time, '
+            'weakref; before = set(sys.modules); import q; print(sorted(%r & '
+            'set(sys.modules) - before))' % set(lazy)], cwd=qpath)
+        self.assertEqual(output.strip(), b'[]')
+
+        # They are imported when they are needed.
+        import q
+        q.writer.color = False
+        q('LazyImport')
+        self.assertIn('ast', sys.modules)
+        self.assertEqual(q.ast, sys.modules['ast'])
+
     def test_q_trace(self):
         import q
         q.writer.color = False
@@ -176,6 +940,197 @@ class TestQBasic(unittest.TestCase):
         self.assertInQLog("log1\\('log1 message'\\)")
         self.assertInQLog("log2\\('log2 message'\\)")
 
+    def test_q_trace_generator(self):
+        import q
+        q.writer.color = False
+
+        @q
+        def gen_items(n):
+            for i in range(n):
+                q('InGenerator%d' % i)
+                received = yield 'Item%d' % i
+                if received:
+                    q(received)
+
+        self.assertEqual(list(gen_items(2)), ['Item0', 'Item1'])
+        self.assertInQLog(r"gen_items\(2\)"
+                          r"\n.*s   gen_items: .*'InGenerator0'"
+                          r"\n.*s   yield 'Item0'"
+                          r"\n.*s   gen_items: .*'InGenerator1'"
+                          r"\n.*s   yield 'Item1'"
+                          r"\n.*s -> None")
+
+        items = gen_items(2)
+        next(items)
+        items.send('Sent')
+        self.assertInQLog(r"s   <- 'Sent'\n.*s   gen_items: .*'Sent'")
+
+        try:
+            raise ValueError('Thrown')
+        except ValueError:
+            error, tb = sys.exc_info()[1:]
+        items = gen_items(2)
+        next(items)
+        self.assertRaises(ValueError, items.throw, ValueError, error, tb)
+        self.assertNotIn('traceback object', self.read_log())
+        self.assertInQLog(r"ValueError\('Thrown'")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires Python 3.7+")
+    def test_q_trace_async(self):
+        import asyncio
+        import q
+        q.writer.color = False
+        namespace = {'asyncio': asyncio, 'q': q}
+        exec('''if 1:
+            async def coro(x):
+                await asyncio.sleep(0)
+                q('InCoroutine')
+                return x * 2
+
+            async def agen():
+                yield 'AsyncItem'
+                await asyncio.sleep(0)
+                raise ValueError('AsyncError')
+
+            coro = q.trace(coro)
+            agen = q.trace(agen)
+
+            async def main():
+                result = await asyncio.create_task(coro(21))
+                items = []
+                try:
+                    async for item in agen():
+                        items.append(item)
+                except ValueError:
+                    pass
+                return result, items
+        ''', namespace)
+        result = asyncio.run(namespace['main']())
+        self.assertEqual(result, (42, ['AsyncItem']))
+        # Frameworks still know to await a traced async def.
+        self.assertTrue(asyncio.iscoroutinefunction(namespace['coro']))
+        if sys.version_info >= (3, 12):
+            import inspect
+            self.assertTrue(inspect.iscoroutinefunction(namespace['coro']))
+        self.assertFalse(asyncio.iscoroutinefunction(namespace['agen']))
+        self.assertInQLog(r"coro\(21\)"
+                          r"\n.*\]   coro: .*'InCoroutine'"
+                          r"\n.*\] -> 42")
+        self.assertInQLog(r"agen\(\)"
+                          r"\n.*\]   yield 'AsyncItem'"
+                          r"\n.*\] !> ValueError\('AsyncError'")
+
+    def test_q_trace_module(self):
+        import types
+        import q
+        q.writer.color = False
+        module = types.ModuleType('q_traced_module')
+        exec('''if 1:
+            def parse(x):
+                return helper(x) + 1
+
+            def helper(x):
+                return x * 2
+
+            class Parser(object):
+                def feed(self, x):
+                    return x
+
+                @staticmethod
+                def check(x):
+                    return x
+        ''', vars(module))
+        parse, helper = module.parse, module.helper
+        q.trace_module(module, exclude='help*')
+        try:
+            self.assertIsNot(module.parse, parse)
+            self.assertIs(module.helper, helper)
+            self.assertEqual(module.parse(20), 41)
+            self.assertEqual(module.Parser().feed('Fed'), 'Fed')
+            self.assertEqual(module.Parser.check('Checked'), 'Checked')
+        finally:
+            q.untrace(module)
+        self.assertIs(module.parse, parse)
+        self.assertEqual(module.Parser.check('Unchecked'), 'Unchecked')
+        self.assertInQLog(r"parse\(20\).*-> 41")
+        self.assertInQLog(r"feed\(<.*>, 'Fed'\)")
+        self.assertInQLog(r"check\('Checked'\)")
+        self.assertNotIn('Unchecked', self.read_log())
+
+        q.trace_class(module.Parser, include='*.feed')
+        try:
+            self.assertEqual(module.Parser.check('Unchecked'), 'Unchecked')
+            self.assertEqual(module.Parser().feed('Fed2'), 'Fed2')
+        finally:
+            q.untrace()
+        self.assertInQLog(r"feed\(<.*>, 'Fed2'\)")
+        self.assertNotIn('Unchecked', self.read_log())
+
+    def test_q_watch(self):
+        import q
+        q.writer.color = False
+
+        def scale(value, factor=2, *rest):
+            return value * factor
+
+        def fail(value):
+            raise ValueError(value)
+
+        q.watch(scale, fail)
+        try:
+            self.assertEqual(scale('ab', 3), 'ababab')
+            self.assertRaises(ValueError, fail, 'watched failure')
+        finally:
+            q.unwatch()
+        scale('unwatched', 1)
+        self.assertInQLog(r"scale\(value='ab', factor=3, rest=\(\)\)")
+        self.assertInQLog(r"-> 'ababab'")
+        self.assertInQLog(r"fail\(value='watched failure'\)")
+        self.assertInQLog(r"!> ValueError\('watched failure'")
+        self.assertNotIn('-> None', self.read_log())
+        self.assertNotIn('unwatched', self.read_log())
+
+    @unittest.skipIf(sys.version_info >= (3, 12), "uses sys.monitoring")
+    def test_q_watch_keeps_tracer(self):
+        import threading
+        import q
+
+        def tracer(frame, event, arg):
+            return None
+
+        def thread_tracer(frame, event, arg):
+            return None
+
+        sys.settrace(tracer)
+        try:
+            self.assertRaises(RuntimeError, q.watch, q.get_code)
+            self.assertIs(sys.gettrace(), tracer)
+        finally:
+            sys.settrace(None)
+        threading.settrace(thread_tracer)
+        try:
+            q.watch(q.get_code)
+            q.unwatch()
+            self.assertIs(sys.gettrace(), None)
+            self.assertIs(threading._trace_hook, thread_tracer)
+        finally:
+            threading.settrace(None)
+
+    def test_q_call_below_decorator(self):
+        # A q() call a line or two below "@q" is a call, not a decorator.
+        import q
+        q.writer.color = False
+
+        @q
+        def traced(value):
+            q(len)
+            q(value)
+            return value
+
+        self.assertEqual(traced('BelowDecorator'), 'BelowDecorator')
+        self.assertInQLog(r"traced: len=<built-in function len>")
+        self.assertInQLog(r"traced: value='BelowDecorator'")
+
     def test_q_nested_bad_wrapper(self):
         # See http://micheles.googlecode.com/hg/decorator/documentation.html#statement-of-the-problem # noqa
         import q